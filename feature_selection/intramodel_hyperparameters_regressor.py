@@ -7,6 +7,7 @@ import utils_model_genetic
 import pickle
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error 
 import utils_exomodel 
+import utils_linear_scoring
 import lightgbm as lgb 
 from sklearn.model_selection  import train_test_split
 from sklearn.ensemble import RandomForestRegressor, AdaBoostRegressor, \
@@ -47,6 +48,7 @@ class LGBM():
     """docstring for ClassName"""
     def __init__(self, lgb, N):
         self.model = ""
+        self.n_estimators = 100
         self.cores_number = int(np.ceil(multiprocessing.cpu_count()/N))
         print("Lightgbm Cores: ")
 
@@ -58,9 +60,10 @@ class LGBM():
         self.model= lgb.LGBMRegressor(
                         num_leaves=31,
                         learning_rate=0.1,
-                        n_estimators=100,
+                        n_estimators=self.n_estimators,
                         subsample=.9,
                         colsample_bytree=.9,
+                        n_jobs=self.cores_number,
                         random_state=1 )
         self.model.fit(
                 X_train, y_train,
@@ -143,6 +146,7 @@ class XGBOOST():
     """docstring for ClassName"""
     def __init__(self, XGBRegressor, N):
         self.model = XGBRegressor
+        self.n_estimators = 800
         self.cores_number = int(np.ceil(multiprocessing.cpu_count()/N))
         print("XGBoostRegressor Cores: ", self.cores_number )
 
@@ -153,10 +157,10 @@ class XGBOOST():
 
         self.model = XGBRegressor(max_depth=6, 
                         learning_rate=0.07, 
-                        n_estimators=800, 
+                        n_estimators=self.n_estimators, 
                         silent=True, 
                         objective='reg:linear', 
-                        nthread=1, 
+                        nthread=self.cores_number, 
                         gamma=0,
                         min_child_weight=1, 
                         max_delta_step=0, 
@@ -497,15 +501,19 @@ def load_models():
                       #                     "model_name": "", 
                       #                     "params" : {"n_workers" = 16}
 
-                      "bayesridge"       : { "function": utils_model_genetic.score_model, 
+                      "bayesridge"       : { "function": utils_linear_scoring.score_linear_model, 
                                             "model_class":BAYESIANRIDGE(BayesianRidge, N), 
                                               "model_name": "bayesridge", 
-                                              "params" : {"n_workers":  16}},
+                                              "params" : {"n_workers":  16},
+                                             "batch_function": utils_linear_scoring.score_linear_population,
+                                             "gram_function": utils_linear_scoring.build_gram_store},
 
-                      "elasticnet"       : { "function": utils_model_genetic.score_model, 
+                      "elasticnet"       : { "function": utils_linear_scoring.score_linear_model, 
                                             "model_class":ELASTIC(ElasticNet, N), 
                                              "model_name": "elasticnet", 
-                                             "params" : {"n_workers" : 16}},
+                                             "params" : {"n_workers" : 16},
+                                             "batch_function": utils_linear_scoring.score_linear_population,
+                                             "gram_function": utils_linear_scoring.build_gram_store},
 
                       "randomforest"     : { "function": utils_model_genetic.score_model, 
                                              "model_class":RANDOMFOREST(RandomForestRegressor, N), 
@@ -527,10 +535,12 @@ def load_models():
                                              "model_name": "gaussiannb", 
                                              "params" : {"n_workers": 16}},
 
-                      "linear"           : { "function": utils_model_genetic.score_model, 
+                      "linear"           : { "function": utils_linear_scoring.score_linear_model, 
                                              "model_class":LINEARREGRESSION(LinearRegression, N),
                                              "model_name": "linear", 
-                                             "params" : {"n_workers": 16}},
+                                             "params" : {"n_workers": 16},
+                                             "batch_function": utils_linear_scoring.score_linear_population,
+                                             "gram_function": utils_linear_scoring.build_gram_store},
 
                       "test_parallel"     : { "function": utils_model_genetic.score_model, 
                                              "model_class":TEST_PARALLEL( "", N),
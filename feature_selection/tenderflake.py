@@ -133,11 +133,8 @@ if True:
 
     #-------------------GENETIC ALGORITM PER MODEL ----------------------------------
 
-    for n_col in NEURONAL_SOLUTIONS.keys():
-        for m_row in NEURONAL_SOLUTIONS[n_col].keys():
-            model_name = NEURONAL_SOLUTIONS[n_col][m_row]["generate_model_populationme"]
-            model = NEURONAL_SOLUTIONS[n_col][m_row]["model"]
-            neuron_name = NEURONAL_SOLUTIONS[n_col][m_row]["name"]
+    #Every neuron runs its own GA, layer k+1 starts as soon as the neurons it uses are trained.
+    NEURONAL_SOLUTIONS = utils_exomodel.solve_neuronal_system(NEURONAL_SOLUTIONS, df_kfolded, 50, .22, .1, 15)
 
 
 
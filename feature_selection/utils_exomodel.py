@@ -8,6 +8,16 @@ from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
 import importlib 
 from sklearn import linear_model
 from sklearn.model_selection import GroupKFold
+import multiprocessing
+import queue
+import traceback
+import signal
+import copy
+import collections.abc
+import utils_model_genetic
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def save_obj(obj, name ):
@@ -257,34 +267,232 @@ def simulate_output(NEURONAL_SOLUTIONS, layer, df_kfolded):
                         NEURONAL_SOLUTIONS[n_col][m_row]["output"]["all_data"] = np.append(NEURONAL_SOLUTIONS[n_col][m_row]["output"]["all_data"], NEURONAL_SOLUTIONS[n_col][m_row]["output"][fold])
 
 
-def get_models_output(NEURONAL_SOLUTIONS, df_kfolded):
+def build_output_store(NEURONAL_SOLUTIONS, df_kfolded):
+    """
+    Preallocates the outputs of every neuron of NEURONAL_SOLUTIONS, one column per neuron:
+        OUTPUTS["names"]        neuron names in layer order, the columns of the store.
+        OUTPUTS["position"]     column of every neuron name.
+        OUTPUTS["index"][fold]  df_kfolded[fold]["index"], the rows of the fold.
+        OUTPUTS["data"][fold]   float32 matrix (rows of fold, neurons), NaN until the neuron
+                                writes its output with write_output.
+        OUTPUTS["written"]      names of the neurons whose output is in the store.
+    """
+    names = [NEURONAL_SOLUTIONS[n_col][m_row]["name"] for n_col in NEURONAL_SOLUTIONS.keys()
+             for m_row in NEURONAL_SOLUTIONS[n_col].keys()]
+    OUTPUTS = dict()
+    OUTPUTS["names"]    = names
+    OUTPUTS["position"] = dict([(name, position) for position, name in enumerate(names)])
+    OUTPUTS["index"]    = dict()
+    OUTPUTS["data"]     = dict()
+    OUTPUTS["written"]  = set()
+    for fold in df_kfolded.keys():
+        OUTPUTS["index"][fold] = df_kfolded[fold]["index"]
+        OUTPUTS["data"][fold]  = np.full((len(df_kfolded[fold]["index"]), len(names)), np.nan, dtype = np.float32)
+    return OUTPUTS
+
+
+def write_output(OUTPUTS, name, output):
+    """
+    Copies output[fold] (see simulate_output) into the column of neuron name for every fold
+    of the store and returns the columns, views of the store with the same format as output.
+    Writing a neuron never touches the columns of the others.
+    """
+    position = OUTPUTS["position"][name]
+    columns = dict()
+    for fold in OUTPUTS["data"].keys():
+        OUTPUTS["data"][fold][:, position] = output[fold]
+        columns[fold] = OUTPUTS["data"][fold][:, position]
+    OUTPUTS["written"].add(name)
+    return columns
+
+
+def get_models_output(NEURONAL_SOLUTIONS, df_kfolded, neurons = None, OUTPUTS = None):
     """
     For LAYER N > 0, some models may need the predictions of previous models.
     this function returnsa DataFreme with the output of all the previous models runned.
     df_exmodel contains an entry for every fold.
     df_exmodel[fold] = DataFrame cols = Nn_Mm_modelname for all n, m. 
     df_exmodel[fold] = NEURONAL_SOLUTIONS[n_col][m_row]["output][fold] for all n_col, m_row
+    neurons is a list of (n_col, m_row) to restrict df_exmodel to their outputs.
 
+    The DataFrames are built over the columns of OUTPUTS (see build_output_store), which is
+    filled with the "output" of the neurons when it is not given. When the neurons are
+    consecutive columns of the store df_exmodel[fold] is a view, otherwise a single copy.
     """
+    if neurons is None:
+        neurons = [(n_col, m_row) for n_col in NEURONAL_SOLUTIONS.keys() for m_row in NEURONAL_SOLUTIONS[n_col].keys()]
+    names = [NEURONAL_SOLUTIONS[n_col][m_row]["name"] for n_col, m_row in neurons]
+    if OUTPUTS is None:
+        OUTPUTS = build_output_store(NEURONAL_SOLUTIONS, df_kfolded)
+        for n_col, m_row in neurons:
+            write_output(OUTPUTS, NEURONAL_SOLUTIONS[n_col][m_row]["name"], NEURONAL_SOLUTIONS[n_col][m_row]["output"])
+
+    missing = [name for name in names if name not in OUTPUTS["written"]]
+    if len(missing) > 0:
+        raise ValueError("Neurons without output: {}".format(missing))
+    positions = [OUTPUTS["position"][name] for name in names]
+    if len(positions) > 0 and positions == list(range(positions[0], positions[0] + len(positions))):
+        positions = slice(positions[0], positions[0] + len(positions))
     df_exmodel = dict()
     for fold in df_kfolded.keys():
-        df_exmodel[fold] = pd.DataFrame()
-        for n_col in NEURONAL_SOLUTIONS.keys():
-            for m_row in NEURONAL_SOLUTIONS[n_col].keys():
-                name    = NEURONAL_SOLUTIONS[n_col][m_row]["name"]
-                index   = df_kfolded[fold]["index"]
-                output  = NEURONAL_SOLUTIONS[n_col][m_row]["output"][fold]
-                df_fold = pd.DataFrame( data = output, index =  index, columns = [name])
-                #print(df_fold.head())
-                if len(df_exmodel[fold]) == 0:
-                    df_exmodel[fold] = df_fold
-                    #print(df_exmodel[fold].shape)
-                else:
-                    df_exmodel[fold] = df_exmodel[fold].merge(df_fold, right_index = True, left_index = True)
-                    #print(df_exmodel[fold].shape)
+        df_exmodel[fold] = pd.DataFrame(OUTPUTS["data"][fold][:, positions], index = OUTPUTS["index"][fold],
+                                        columns = names, copy = False)
     return df_exmodel
 
 
+def neuron_dependencies(NEURONAL_SOLUTIONS):
+    """
+    DEPENDENCIES[(n_col, m_row)] = set of (n_col, m_row) of the neurons whose output is in
+    the exmodel features of the neuron (see decode_neuronal_system). A neuron can be
+    trained as soon as all of them have their "output".
+    """
+    positions = dict()
+    for n_col in NEURONAL_SOLUTIONS.keys():
+        for m_row in NEURONAL_SOLUTIONS[n_col].keys():
+            positions[NEURONAL_SOLUTIONS[n_col][m_row]["name"]] = (n_col, m_row)
+
+    DEPENDENCIES = dict()
+    for n_col in NEURONAL_SOLUTIONS.keys():
+        for m_row in NEURONAL_SOLUTIONS[n_col].keys():
+            DEPENDENCIES[(n_col, m_row)] = set()
+            for layer in NEURONAL_SOLUTIONS[n_col][m_row]["exmodel"].keys():
+                for feature in NEURONAL_SOLUTIONS[n_col][m_row]["exmodel"][layer]["features"]:
+                    DEPENDENCIES[(n_col, m_row)].add(positions[feature])
+    return DEPENDENCIES
+
+
+def solve_neuronal_system(NEURONAL_SOLUTIONS, df_kfolded, N, PC, PM, MAX_ITERATIONS, n_cores = None,
+                          cores_per_neuron = None, max_features = 1000, **kwargs):
+    """
+    Trains every neuron of NEURONAL_SOLUTIONS: a genetic algorithm selects the features of
+    the neuron model (see utils_model_genetic.solve_genetic_algorithm) and the best
+    individual is refitted fold by fold to fill NEURONAL_SOLUTIONS[n_col][m_row]["output"]
+    with its out-of-fold predictions, in the same format as simulate_output, plus "score"
+    and "solution", the SOLUTIONS entry of the best individual.
+
+    The neurons run concurrently, each one in its own process (see neuron_loop) with a
+    worker pool of cores_per_neuron processes (n_cores // M by default, a whole layer at
+    once), and never more than n_cores (cpu_count by default) cores in total. A neuron
+    starts as soon as the neurons it depends on (see neuron_dependencies) have their
+    output, not when the whole previous layer is finished, and only the outputs of those
+    neurons are in its df_exmodel. The outputs are kept in the store of build_output_store,
+    "output" holds views of it. The model wrappers of the workers fit with a single thread.
+    When a neuron fails the running ones are stopped with SIGTERM and clean up their own
+    workers and shared memory before exiting (see neuron_loop).
+    kwargs are passed to solve_genetic_algorithm (parallel_execution = True by default).
+    """
+    n_cores = n_cores or multiprocessing.cpu_count()
+    M = max([len(NEURONAL_SOLUTIONS[n_col]) for n_col in NEURONAL_SOLUTIONS.keys()])
+    cores_per_neuron = min(cores_per_neuron or max(1, n_cores // M), n_cores)
+    kwargs.setdefault("parallel_execution", True)
+
+    DEPENDENCIES = neuron_dependencies(NEURONAL_SOLUTIONS)
+    for n_col, m_row in DEPENDENCIES.keys():
+        NEURONAL_SOLUTIONS[n_col][m_row].pop("output", None)
+    OUTPUTS  = build_output_store(NEURONAL_SOLUTIONS, df_kfolded)
+    seeds    = dict([(neuron, position) for position, neuron in enumerate(DEPENDENCIES.keys())])
+    seed     = np.random.randint(0, 2**31 - len(seeds))
+    pending  = list(DEPENDENCIES.keys())
+    finished = set()
+    RUNNING  = dict()
+    RESULTS  = multiprocessing.Queue()
+    slots    = max(1, n_cores // cores_per_neuron)
+    try:
+        while len(pending) > 0 or len(RUNNING) > 0:
+            ready = [neuron for neuron in pending if DEPENDENCIES[neuron] <= finished]
+            for neuron in ready[:slots - len(RUNNING)]:
+                pending.remove(neuron)
+                df_exmodel = None
+                if len(DEPENDENCIES[neuron]) > 0:
+                    df_exmodel = get_models_output(NEURONAL_SOLUTIONS, df_kfolded, sorted(DEPENDENCIES[neuron]),
+                                                   OUTPUTS)
+                logger.info("NEURON %s started, %s cores", NEURONAL_SOLUTIONS[neuron[0]][neuron[1]]["name"],
+                            cores_per_neuron)
+                #Not daemonic, the neuron starts its own worker pool.
+                process = multiprocessing.Process( target = neuron_loop,
+                                                   args = (NEURONAL_SOLUTIONS, neuron, df_kfolded, df_exmodel,
+                                                           RESULTS, seed + seeds[neuron], N, PC, PM, MAX_ITERATIONS,
+                                                           cores_per_neuron, max_features, kwargs, ))
+                process.start()
+                RUNNING[neuron] = process
+            if len(RUNNING) == 0:
+                raise ValueError("Neurons with circular dependencies: {}".format(pending))
+
+            try:
+                neuron, NEURON_RESULT = RESULTS.get(timeout = 5)
+            except queue.Empty:
+                if not all([process.is_alive() for process in RUNNING.values()]) and RESULTS.empty():
+                    raise RuntimeError("A neuron process died while solving its genetic algorithm")
+                continue
+            RUNNING.pop(neuron).join()
+            if NEURON_RESULT is None:
+                raise RuntimeError("Neuron {} failed while solving its genetic algorithm".format(
+                                   NEURONAL_SOLUTIONS[neuron[0]][neuron[1]]["name"]))
+            NEURON_RESULT["output"] = write_output(OUTPUTS, NEURONAL_SOLUTIONS[neuron[0]][neuron[1]]["name"],
+                                                   NEURON_RESULT["output"])
+            NEURONAL_SOLUTIONS[neuron[0]][neuron[1]].update(NEURON_RESULT)
+            finished.add(neuron)
+            logger.info("NEURON %s finished, score: %s", NEURONAL_SOLUTIONS[neuron[0]][neuron[1]]["name"],
+                        NEURON_RESULT["score"])
+    finally:
+        for process in RUNNING.values():
+            process.terminate()
+            process.join()
+    return NEURONAL_SOLUTIONS
+
+
+def neuron_loop(NEURONAL_SOLUTIONS, neuron, df_kfolded, df_exmodel, RESULTS, seed, N, PC, PM, MAX_ITERATIONS,
+                cores, max_features, kwargs):
+    """
+    Body of every neuron process of solve_neuronal_system. Sends (neuron, NEURON_RESULT)
+    through RESULTS, NEURON_RESULT being the "score", "solution" and "output" of the
+    neuron, or (neuron, None) when it fails. SIGTERM (solve_neuronal_system stopping the
+    neurons still running) exits through SystemExit, so the finally of
+    solve_genetic_algorithm stops the worker pool and releases the fold store.
+    """
+    signal.signal(signal.SIGTERM, utils_model_genetic.exit_on_sigterm)
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        NEURON_RESULT = solve_neuron(NEURONAL_SOLUTIONS, neuron[0], neuron[1], df_kfolded, df_exmodel, N, PC, PM,
+                                     MAX_ITERATIONS, cores, max_features, kwargs)
+    except Exception:
+        traceback.print_exc()
+        NEURON_RESULT = None
+    RESULTS.put((neuron, NEURON_RESULT))
+
+
+def solve_neuron(NEURONAL_SOLUTIONS, n_col, m_row, df_kfolded, df_exmodel, N, PC, PM, MAX_ITERATIONS,
+                 cores, max_features, kwargs):
+    """
+    Runs the genetic algorithm of the neuron at n_col, m_row with a pool of cores workers
+    and returns the score, the SOLUTIONS entry and the out-of-fold output of its best
+    individual.
+    """
+    NEURON = NEURONAL_SOLUTIONS[n_col][m_row]
+    MODEL = dict(NEURON["model"])
+    MODEL["params"] = dict(MODEL["params"], n_workers = 1)
+    MODEL["model_class"] = utils_model_genetic.limit_cores(copy.deepcopy(MODEL["model_class"]), 1)
+    folds = [fold for fold in df_kfolded.keys() if fold != "all_data"]
+    columns_list = list(df_kfolded[folds[0]]["data"].columns)
+
+    POPULATION_X, SOLUTIONS = utils_model_genetic.solve_genetic_algorithm(N, PC, PM, cores, MAX_ITERATIONS, MODEL,
+                                  NEURONAL_SOLUTIONS, n_col, columns_list, df_kfolded, df_exmodel = df_exmodel,
+                                  max_features = max_features, **kwargs)
+    BEST = max(POPULATION_X.values(), key = lambda INDIVIDUAL: INDIVIDUAL["SCORE"])
+
+    output = utils_model_genetic.out_of_fold_predictions(BEST, MODEL, df_kfolded, df_exmodel)
+    if "all_data" in df_kfolded:
+        all_data = pd.Series(np.concatenate([output[fold] for fold in folds]),
+                             index = np.concatenate([np.asarray(df_kfolded[fold]["index"]) for fold in folds]))
+        output["all_data"] = all_data.reindex(df_kfolded["all_data"]["index"]).to_numpy()
+    NEURON_RESULT = dict()
+    NEURON_RESULT["score"]    = BEST["SCORE"]
+    NEURON_RESULT["solution"] = SOLUTIONS.get(BEST["GENOMA"])
+    NEURON_RESULT["output"]   = output
+    return NEURON_RESULT
+
+
 def get_exmodel_features(NEURONAL_SOLUTIONS, eval_layer):
     """
     Append all exmodel output features names to call them from the df_exmodel dataset.
@@ -315,50 +523,35 @@ def transform_categorical(df):
     return df
 
 
-def transform_KFold_random(df, y_column, K):
-
+def transform_KFold_random(df, y_column, K, seed = None, stratify_quantiles = None):
+    """
+    Generates a df_kfolded dictionary with K random folds of df of the same size (the
+    first len(df) % K folds have one more row). df_kfolded[k]["index"] are the positions
+    of the rows of fold k in df after reset_index, "data" their features and "y" their
+    target. df_kfolded["all_data"] keeps every row in the original order.
+
+    The rows are permuted once and the folds are slices of the permuted data (see
+    build_kfolded), so the split is O(n) and no fold is copied.
+        seed:               seed of the permutation, with None np.random is used.
+        stratify_quantiles: number of target quantiles; the rows of every quantile are
+                            dealt evenly among the folds so every fold has the same
+                            distribution of y_column.
+    """
     df = df.reset_index()
-    all_index =  df.index
-    df_kfolded = dict()
-    obs_per_fold = int(np.round(len(df)/K))
-
-    for k in range(K):
-        print("K: {}  all_index: {} ".format(k, len(all_index)))
-        df_kfolded[k] = dict()
-        df_copy = df.copy()
-        if k == K-1:
-            df_kfolded[k]["y"] = df_copy.loc[all_index, y_column]
-            del df_copy[y_column]
-            df_kfolded[k]["data"]  = df_copy.loc[all_index]
-            df_kfolded[k]["index"] = all_index
-            if y_column in df_kfolded[k]["data"]:
-                print("\n\n\nERROR: Target variable in df_kfolded[k][data]")
-        else:
-
-            fold_index = np.random.choice(all_index, obs_per_fold, replace= False)
-            fold_data  = df_copy.loc[fold_index]
-            fold_y     = fold_data[y_column]
-            del fold_data[y_column]
-
-            all_index = [item for item in all_index if item not in fold_index]
-
-            df_kfolded[k]["index"] = fold_index
-            df_kfolded[k]["data"]  = fold_data
-            df_kfolded[k]["y"]     = fold_y
-
-            if y_column in df_kfolded[k]["data"]:
-                print("\n\n\nERROR: Target variable in df_kfolded[k][data]")
-
-        print( len(df_kfolded[k]["index"]))
-
-    df_copy = df.copy()
-    df_kfolded["all_data"] = dict()
-    df_kfolded["all_data"]["index"] =  df.index
-    df_kfolded["all_data"]["y"]     =  df_copy[y_column]
-    del df_copy[y_column]
-    df_kfolded["all_data"]["data"]  =  df_copy
+    n_rows = len(df)
+    random_state = np.random if seed is None else np.random.RandomState(seed)
+    order = random_state.permutation(n_rows)
+    fold_sizes = np.bincount(np.arange(n_rows) % K, minlength = K)
 
-    return df_kfolded
+    if stratify_quantiles:
+        quantile = pd.qcut(df[y_column], stratify_quantiles, labels = False, duplicates = "drop")
+        quantile = quantile.fillna(-1).to_numpy(dtype = np.int16)
+        #Stable sorts of small integers are radix sorts: rows grouped by quantile, random
+        #inside each quantile, then dealt round-robin and grouped by fold.
+        order = order[np.argsort(quantile[order], kind = "stable")]
+        order = order[np.argsort((np.arange(n_rows) % K).astype(np.int16), kind = "stable")]
+
+    return build_kfolded(df, y_column, np.split(order, np.cumsum(fold_sizes)[:-1]))
 
 def transform_KFold_groups(df, y_column, K, group_id):
     """Generates a df_kfolded dictioanry. Each entry in the dictionary conatins a fold which have a 
@@ -367,7 +560,6 @@ def transform_KFold_groups(df, y_column, K, group_id):
     of these list and the interection of all the subsets will be null.
     Also the function have a balanced number of opservation in each fold """
     df = df.reset_index(drop = True)
-    df_kfolded = dict()
     unique_vis = np.array(sorted(df[group_id].unique()))
 
     # Get folds
@@ -382,19 +574,60 @@ def transform_KFold_groups(df, y_column, K, group_id):
                 ids[df[group_id].isin(unique_vis[val_vis])]
             ]
         )
-    for k, (trn_, val_) in enumerate(fold_ids):
-        df_kfolded[k] = dict()
-        df_kfolded[k]["data"]  = df.iloc[val_]
-        df_kfolded[k]["index"] = val_
-        df_kfolded[k]["y"]     =  df.iloc[val_][y_column]
-        del df_kfolded[k]["data"][y_column]
-
-    df_copy = df.copy()
-    df_kfolded["all_data"] = dict()
-    df_kfolded["all_data"]["data"]  =  df_copy
-    df_kfolded["all_data"]["index"] =  df.index
-    df_kfolded["all_data"]["y"]     =  df_copy[y_column]
-    del df_kfolded["all_data"]["data"][y_column]
+    return build_kfolded(df, y_column, [val_ for trn_, val_ in fold_ids])
 
+
+def build_kfolded(df, y_column, fold_positions):
+    """
+    Builds a df_kfolded whose fold k has the rows of df at positions fold_positions[k]
+    (the folds must cover every row once). The features and the target are copied once,
+    with the rows in fold order, and every entry of df_kfolded is a LazyFold over them:
+    a fold is a slice of the copy and "all_data" the original row order, so the dataset
+    is in memory once instead of once for the folds plus once for "all_data".
+    """
+    order = np.concatenate(fold_positions)
+    features = [position for position, column in enumerate(df.columns) if column != y_column]
+    data = df.iloc[order, features]
+    y    = df[y_column].iloc[order]
+    labels = df.index.to_numpy()
+
+    df_kfolded = dict()
+    start = 0
+    for k in range(len(fold_positions)):
+        end = start + len(fold_positions[k])
+        df_kfolded[k] = LazyFold(data, y, slice(start, end), labels[order[start:end]])
+        logger.debug("fold %s rows: %s", k, end - start)
+        start = end
+
+    original_order = np.empty(len(order), dtype = np.int64)
+    original_order[order] = np.arange(len(order))
+    df_kfolded["all_data"] = LazyFold(data, y, original_order, df.index)
     return df_kfolded
 
+
+class LazyFold(collections.abc.Mapping):
+    """
+    Entry of a df_kfolded built by build_kfolded. It keeps the frames shared by all the
+    folds and the rows of the fold in them; fold["data"] and fold["y"] are built when they
+    are read (views when rows is a slice) and fold["index"] is the index of those rows.
+    """
+    def __init__(self, data, y, rows, index):
+        self.shared_data = data
+        self.shared_y    = y
+        self.rows        = rows
+        self.index       = index
+
+    def __getitem__(self, key):
+        if key == "data":
+            return self.shared_data.iloc[self.rows]
+        if key == "y":
+            return self.shared_y.iloc[self.rows]
+        if key == "index":
+            return self.index
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(["data", "y", "index"])
+
+    def __len__(self):
+        return 3
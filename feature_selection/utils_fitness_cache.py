@@ -0,0 +1,115 @@
+import numpy as np
+import hashlib
+import pickle
+import sqlite3
+
+
+def folds_fingerprint(FOLDS, df_exmodel = None):
+    """
+    sha1 of the data used to score an individual: the columns, the fold layout and the
+    X, y, index blocks of FOLDS (see utils_fold_store.attach_fold_store) plus the
+    exmodel outputs when df_exmodel is given. X is Fortran ordered, so its transpose is
+    hashed in place instead of making a C ordered copy of the whole dataset.
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr(FOLDS["columns"]).encode())
+    fingerprint.update(repr([(fold, FOLDS["fold_rows"][fold]) for fold in FOLDS["folds"]]).encode())
+    fingerprint.update(np.ascontiguousarray(FOLDS["X"].T).data)
+    for key in ["y", "index"]:
+        fingerprint.update(np.ascontiguousarray(FOLDS[key]).data)
+    if df_exmodel:
+        for fold in FOLDS["folds"]:
+            fingerprint.update(repr(list(df_exmodel[fold].columns)).encode())
+            fingerprint.update(np.ascontiguousarray(df_exmodel[fold].to_numpy(dtype = np.float64)).data)
+    return fingerprint.hexdigest()
+
+
+def model_signature(MODEL):
+    """
+    Text that identifies the model and its params: model_name, MODEL["params"] and the
+    get_params() of the estimator inside MODEL["model_class"] when it has one. Wrappers that
+    keep the estimator class instead of an instance (XGBOOST) are identified by its repr.
+    """
+    estimator = getattr(MODEL["model_class"], "model", None)
+    if hasattr(estimator, "get_params") and not isinstance(estimator, type):
+        estimator_params = sorted([(key, repr(value)) for key, value in estimator.get_params().items()])
+    else:
+        estimator_params = repr(estimator)
+    return repr((MODEL["model_name"], sorted(MODEL["params"].items()), estimator_params))
+
+
+def open_fitness_cache(path, MODEL, FOLDS, df_exmodel, error_type, max_features):
+    """
+    Opens (or creates) the SQLite file at path that keeps the score of every genoma across
+    runs. The key of a genoma combines its GENOMA bytes with the model name and params,
+    the error type, max_features and the fingerprint of the folds, so a cached score is
+    only reused when it would be recomputed exactly the same way.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE IF NOT EXISTS fitness (key TEXT PRIMARY KEY, score REAL, solution BLOB)")
+    connection.commit()
+
+    prefix = hashlib.sha1()
+    prefix.update(model_signature(MODEL).encode())
+    prefix.update(repr((error_type, max_features)).encode())
+    prefix.update(folds_fingerprint(FOLDS, df_exmodel).encode())
+
+    FITNESS_CACHE = dict()
+    FITNESS_CACHE["connection"] = connection
+    FITNESS_CACHE["prefix"] = prefix.hexdigest()
+    FITNESS_CACHE["stored"] = set()
+    FITNESS_CACHE["hits"]   = 0
+    return FITNESS_CACHE
+
+
+def fitness_key(FITNESS_CACHE, genoma):
+    return FITNESS_CACHE["prefix"] + ":" + genoma.hex()
+
+
+def load_solutions(FITNESS_CACHE, POPULATION, SOLUTIONS):
+    """
+    Copies into SOLUTIONS the cached solution of every genoma of POPULATION that is not
+    in SOLUTIONS yet, so it is not scheduled for fitting.
+    """
+    missing = dict()
+    for individual in POPULATION.keys():
+        genoma = POPULATION[individual]["GENOMA"]
+        if genoma not in SOLUTIONS and genoma not in FITNESS_CACHE["stored"]:
+            missing[fitness_key(FITNESS_CACHE, genoma)] = genoma
+    if len(missing) == 0:
+        return
+
+    keys = list(missing.keys())
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        rows = FITNESS_CACHE["connection"].execute(
+                    "SELECT key, solution FROM fitness WHERE key IN ({})".format(",".join(["?"]*len(chunk))), chunk)
+        for key, solution in rows:
+            SOLUTIONS[missing[key]] = pickle.loads(solution)
+            FITNESS_CACHE["stored"].add(missing[key])
+            FITNESS_CACHE["hits"] += 1
+
+
+def save_solutions(FITNESS_CACHE, POPULATION, SOLUTIONS):
+    """
+    Writes to the cache the solutions of POPULATION that are not stored yet. Solutions
+    that lost a race (see utils_model_genetic.score_model) only have a partial score and
+    are not stored.
+    """
+    rows = list()
+    for individual in POPULATION.keys():
+        genoma = POPULATION[individual]["GENOMA"]
+        if genoma in FITNESS_CACHE["stored"] or genoma not in SOLUTIONS:
+            continue
+        if SOLUTIONS[genoma].get("raced", False):
+            continue
+        rows.append((fitness_key(FITNESS_CACHE, genoma), SOLUTIONS[genoma]["score"],
+                     pickle.dumps(SOLUTIONS[genoma], pickle.HIGHEST_PROTOCOL)))
+        FITNESS_CACHE["stored"].add(genoma)
+    if len(rows) > 0:
+        FITNESS_CACHE["connection"].executemany("INSERT OR REPLACE INTO fitness VALUES (?, ?, ?)", rows)
+        FITNESS_CACHE["connection"].commit()
+
+
+def close_fitness_cache(FITNESS_CACHE):
+    FITNESS_CACHE["connection"].close()
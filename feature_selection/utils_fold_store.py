@@ -0,0 +1,239 @@
+import pandas as pd
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def build_fold_store(df_kfolded, shared = True, df_exmodel = None):
+    """
+    Packs the folds of df_kfolded ("all_data" is left out) into a single memory block:
+        X      float64 matrix with the rows of every fold stacked in fold order, stored by
+               columns (Fortran order) so every feature is a contiguous array.
+        y      float64 target of every row in X.
+        index  int64 original index of every row in X.
+
+    With df_exmodel the outputs of the neurons present in every fold are appended to X
+    after the baseline columns (FOLD_STORE["exmodel_columns"]), in the same row order, so
+    the features of an individual are a single column selection of X. The rows of
+    df_exmodel[fold] are aligned with df_kfolded[fold]["index"] here, once, see exmodel_rows.
+
+    FOLD_STORE["fold_rows"][fold] = (start, end) position of the fold rows inside X.
+    FOLD_STORE["plan"] = train/test rows of every fold, see build_fold_plan.
+
+    With shared = True the block is created in shared memory and the workers attach to it
+    by name with attach_fold_store, so the dataset is in RAM only once no matter how many
+    workers are scoring individuals. With shared = False the block is a private buffer,
+    which is enough for sequential execution.
+    """
+    folds = [fold for fold in df_kfolded.keys() if fold != "all_data"]
+    columns = list(df_kfolded[folds[0]]["data"].columns)
+
+    non_numeric = [col for col in columns if not pd.api.types.is_numeric_dtype(df_kfolded[folds[0]]["data"][col])]
+    if len(non_numeric) > 0:
+        raise ValueError("build_fold_store requires numeric features, found: {}".format(non_numeric))
+
+    fold_rows = dict()
+    n_rows = 0
+    for fold in folds:
+        if list(df_kfolded[fold]["data"].columns) != columns:
+            raise ValueError("Fold {} doesn't have the same columns as fold {}".format(fold, folds[0]))
+        fold_rows[fold] = (n_rows, n_rows + len(df_kfolded[fold]["data"]))
+        n_rows = fold_rows[fold][1]
+
+    exmodel_columns = list()
+    if df_exmodel:
+        available = set.intersection(*[set(df_exmodel[fold].columns) for fold in folds])
+        exmodel_columns = [column for column in df_exmodel[folds[0]].columns if column in available]
+        baseline = set(columns)
+        repeated = [column for column in exmodel_columns if column in baseline]
+        if len(repeated) > 0:
+            raise ValueError("Exmodel outputs with the name of a baseline feature: {}".format(repeated))
+    n_baseline = len(columns)
+    columns = columns + exmodel_columns
+
+    FOLD_STORE = dict()
+    FOLD_STORE["folds"]     = folds
+    FOLD_STORE["columns"]   = columns
+    FOLD_STORE["exmodel_columns"] = exmodel_columns
+    FOLD_STORE["fold_rows"] = fold_rows
+    FOLD_STORE["shape"]     = (n_rows, len(columns))
+    FOLD_STORE["offsets"]   = {"X": 0,
+                               "y": n_rows*len(columns)*8,
+                               "index": n_rows*len(columns)*8 + n_rows*8}
+    FOLD_STORE["plan"]      = build_fold_plan(FOLD_STORE)
+    size = n_rows*len(columns)*8 + 2*n_rows*8
+
+    if shared:
+        shm = shared_memory.SharedMemory(create = True, size = max(size, 1))
+        FOLD_STORE["name"] = shm.name
+        FOLD_STORE["shm"]  = shm
+        buffer = shm.buf
+    else:
+        FOLD_STORE["name"]   = None
+        FOLD_STORE["buffer"] = bytearray(max(size, 1))
+        buffer = FOLD_STORE["buffer"]
+
+    arrays = fold_store_arrays(FOLD_STORE, buffer)
+    for fold in folds:
+        start, end = fold_rows[fold]
+        arrays["X"][start:end, :n_baseline] = df_kfolded[fold]["data"].to_numpy(dtype = np.float64)
+        if len(exmodel_columns) > 0:
+            arrays["X"][start:end, n_baseline:] = exmodel_rows(df_exmodel[fold], df_kfolded[fold]["index"],
+                                                               exmodel_columns, fold)
+        arrays["y"][start:end]     = np.asarray(df_kfolded[fold]["y"], dtype = np.float64)
+        arrays["index"][start:end] = np.asarray(df_kfolded[fold]["index"], dtype = np.int64)
+    del arrays
+
+    return FOLD_STORE
+
+
+def fold_store_arrays(FOLD_STORE, buffer):
+    """
+    Returns numpy views of X, y and index over buffer. No data is copied.
+    """
+    n_rows, n_columns = FOLD_STORE["shape"]
+    arrays = dict()
+    arrays["X"]     = np.ndarray((n_rows, n_columns), dtype = np.float64, buffer = buffer,
+                                 offset = FOLD_STORE["offsets"]["X"], order = "F")
+    arrays["y"]     = np.ndarray((n_rows,), dtype = np.float64, buffer = buffer,
+                                 offset = FOLD_STORE["offsets"]["y"])
+    arrays["index"] = np.ndarray((n_rows,), dtype = np.int64, buffer = buffer,
+                                 offset = FOLD_STORE["offsets"]["index"])
+    return arrays
+
+
+def attach_fold_store(FOLD_STORE):
+    """
+    Attaches to the block described by FOLD_STORE and returns FOLDS, a dictionary with
+    the numpy views X, y, index, the fold description and the fold plan. Must be called
+    once per worker; the views stay valid until detach_fold_store. Precomputed stores
+    added to FOLD_STORE by the parent (FOLD_STORE["gram"], see
+    utils_linear_scoring.build_gram_store) are shared the same way.
+    FOLDS["blocks"] is the column-block cache of the process, see fold_matrix.
+    """
+    FOLDS = dict()
+    FOLDS["folds"]     = FOLD_STORE["folds"]
+    FOLDS["columns"]   = FOLD_STORE["columns"]
+    FOLDS["fold_rows"] = FOLD_STORE["fold_rows"]
+    FOLDS["column_position"] = dict([(column, position) for position, column in enumerate(FOLD_STORE["columns"])])
+    FOLDS["plan"]      = FOLD_STORE["plan"]
+    FOLDS["blocks"]    = dict()
+    if "gram" in FOLD_STORE:
+        FOLDS["gram"] = FOLD_STORE["gram"]
+    if FOLD_STORE["name"] is None:
+        FOLDS["shm"] = None
+        buffer = FOLD_STORE["buffer"]
+    else:
+        FOLDS["shm"] = shared_memory.SharedMemory(name = FOLD_STORE["name"])
+        buffer = FOLDS["shm"].buf
+    FOLDS.update(fold_store_arrays(FOLD_STORE, buffer))
+    return FOLDS
+
+
+def build_fold_plan(FOLD_STORE):
+    """
+    For every test fold stores the rows of X used to fit and to evaluate a model:
+        PLAN[test_fold]["train"]  rows of every other fold, in fold order.
+        PLAN[test_fold]["test"]   rows of test_fold.
+    The plan only depends on the fold layout, so it is built once per df_kfolded and
+    an individual's training data is a single fancy-index of rows and columns.
+    """
+    PLAN = dict()
+    for test_fold in FOLD_STORE["folds"]:
+        train_rows = list()
+        for train_fold in FOLD_STORE["folds"]:
+            if train_fold != test_fold:
+                start, end = FOLD_STORE["fold_rows"][train_fold]
+                train_rows.append(np.arange(start, end))
+        start, end = FOLD_STORE["fold_rows"][test_fold]
+        PLAN[test_fold] = dict()
+        PLAN[test_fold]["train"] = np.concatenate(train_rows) if len(train_rows) > 0 else np.arange(0)
+        PLAN[test_fold]["test"]  = np.arange(start, end)
+    return PLAN
+
+
+def exmodel_rows(df_exmodel_fold, index, exmodel_columns, fold):
+    """
+    Returns the exmodel_columns of df_exmodel_fold as a float64 matrix whose rows follow
+    index, the rows of the fold. Raises ValueError when the index of df_exmodel_fold has
+    repeated rows or misses rows of the fold.
+    """
+    if not df_exmodel_fold.index.is_unique:
+        raise ValueError("Fold {}: the index of df_exmodel has repeated rows".format(fold))
+    values = df_exmodel_fold[exmodel_columns].to_numpy(dtype = np.float64)
+    if df_exmodel_fold.index.equals(pd.Index(index)):
+        return values
+    positions = df_exmodel_fold.index.get_indexer(index)
+    if (positions < 0).any():
+        raise ValueError("Fold {}: {} rows without exmodel output".format(fold, int((positions < 0).sum())))
+    return values[positions]
+
+
+def fold_matrix(FOLDS, test_fold, columns, train_rows = None):
+    """
+    Returns X_train, X_test and the feature names of their columns for test_fold, with the
+    columns of FOLDS["X"] in positions columns (baseline and exmodel features alike), in
+    the order of columns. train_rows defaults to the training rows of the plan.
+
+    Consecutive individuals usually differ in a few genes, so the matrices are assembled in
+    a block kept in FOLDS["blocks"] for every (test_fold, train rows): a Fortran ordered
+    buffer with the train and test rows and the columns of the previous call in its slots.
+    Slot i is only copied from FOLDS["X"] when columns[i] is not already there, so the
+    order of the columns is always the one requested and the result never depends on what
+    the process scored before. The capacity of a block grows up to the largest request.
+    X_train and X_test are views of the block, valid until the next call for the same fold.
+    """
+    test_rows  = FOLDS["plan"][test_fold]["test"]
+    if train_rows is None:
+        train_rows = FOLDS["plan"][test_fold]["train"]
+    #subsample_rows only depends on the number of rows, so it identifies the train rows.
+    key = (test_fold, len(train_rows))
+    n_columns = len(columns)
+
+    BLOCK = FOLDS["blocks"].get(key)
+    if BLOCK is None or BLOCK["matrix"].shape[1] < n_columns:
+        rows = np.concatenate([train_rows, test_rows])
+        if BLOCK is None:
+            capacity = max(n_columns, 1)
+        else:
+            capacity = max(n_columns, min(2*BLOCK["matrix"].shape[1], len(FOLDS["columns"])))
+        matrix = np.empty((len(rows), capacity), dtype = np.float64, order = "F")
+        slots = [None]*capacity
+        if BLOCK is not None:
+            matrix[:, :BLOCK["matrix"].shape[1]] = BLOCK["matrix"]
+            slots[:len(BLOCK["slots"])] = BLOCK["slots"]
+        BLOCK = {"rows": rows, "n_train": len(train_rows), "matrix": matrix, "slots": slots}
+        FOLDS["blocks"][key] = BLOCK
+
+    matrix, slots = BLOCK["matrix"], BLOCK["slots"]
+    for i, column in enumerate(columns):
+        if slots[i] != column:
+            matrix[:, i] = FOLDS["X"][:, column][BLOCK["rows"]]
+            slots[i] = column
+
+    features = [FOLDS["columns"][column] for column in columns]
+    n_train = BLOCK["n_train"]
+    return matrix[:n_train, :n_columns], matrix[n_train:, :n_columns], features
+
+
+def detach_fold_store(FOLDS):
+    """
+    Drops the views of FOLDS and closes the worker handle of the shared block.
+    """
+    for key in ["X", "y", "index", "blocks"]:
+        FOLDS.pop(key, None)
+    if FOLDS["shm"] is not None:
+        try:
+            FOLDS["shm"].close()
+        except BufferError:
+            #Some view over the block is still alive, it is released with the process.
+            pass
+
+
+def release_fold_store(FOLD_STORE):
+    """
+    Frees the block created by build_fold_store. Only the process that built the
+    store must call it, once every worker has finished.
+    """
+    if FOLD_STORE["name"] is not None:
+        FOLD_STORE["shm"].close()
+        FOLD_STORE["shm"].unlink()
@@ -0,0 +1,326 @@
+import numpy as np
+import logging
+from sklearn.linear_model import BayesianRidge, ElasticNet
+import utils_model_genetic
+
+logger = logging.getLogger(__name__)
+
+
+def build_gram_store(FOLDS):
+    """
+    Precomputes the Gram blocks used by score_linear_model. The design matrix is
+        [1, FOLDS["X"] - GRAM["shift"]]
+    (FOLDS["X"] holds the exmodel outputs after the baseline features, see
+    utils_fold_store.build_fold_store) and for every test fold it stores the Gram matrix,
+    X'y and y'y of its training rows, with y shifted by GRAM["y_shift"]:
+        GRAM["train"][test_fold]["gram"], ["xy"], ["yy"]
+    built as the sum of the blocks of every other fold, so each row is read only once.
+    The shifts are the means of the columns over every row: the blocks are formed on data
+    close to zero mean, so large offsets don't cancel the precision of the centered
+    subsystems (see solve_linear). The intercept is position 0 and column j of FOLDS["X"]
+    is position 1 + j. Memory is one (1 + p) x (1 + p) matrix per fold, with p the number
+    of columns of FOLDS["X"].
+
+    solve_genetic_algorithm builds it once, with MODEL["gram_function"], and shares it with
+    the workers through the fold store.
+    """
+    GRAM = dict()
+    positions = np.arange(1 + len(FOLDS["columns"]))
+    GRAM["shift"]   = np.concatenate([[0], FOLDS["X"].mean(axis = 0)]) if len(FOLDS["y"]) > 0 else np.zeros(len(positions))
+    GRAM["y_shift"] = FOLDS["y"].mean() if len(FOLDS["y"]) > 0 else 0.
+
+    FOLD_GRAM = dict()
+    for fold in FOLDS["folds"]:
+        start, end = FOLDS["fold_rows"][fold]
+        design = design_matrix(FOLDS, np.arange(start, end), positions, GRAM["shift"])
+        y = FOLDS["y"][start:end] - GRAM["y_shift"]
+        FOLD_GRAM[fold] = {"gram": design.T @ design, "xy": design.T @ y, "yy": y @ y}
+
+    GRAM["train"] = dict()
+    for test_fold in FOLDS["folds"]:
+        GRAM["train"][test_fold] = dict()
+        for key in ["gram", "xy", "yy"]:
+            GRAM["train"][test_fold][key] = sum([FOLD_GRAM[fold][key] for fold in FOLDS["folds"] if fold != test_fold])
+    return GRAM
+
+
+def design_matrix(FOLDS, rows, positions, shift):
+    """
+    Returns the rows of the design matrix (see build_gram_store) for the Gram positions,
+    with the columns shifted by shift (indexed by position).
+    """
+    matrix = np.empty((len(rows), len(positions)), dtype = np.float64, order = "F")
+    for i, position in enumerate(positions):
+        if position == 0:
+            matrix[:, i] = 1
+        else:
+            matrix[:, i] = FOLDS["X"][:, position - 1][rows] - shift[position]
+    return matrix
+
+
+def fold_gram(FOLDS):
+    """
+    Returns the Gram store of FOLDS: the one shared by the fold store when there is one,
+    otherwise it is built here, once per process.
+    """
+    if "gram" not in FOLDS:
+        FOLDS["gram"] = build_gram_store(FOLDS)
+    return FOLDS["gram"]
+
+
+def score_linear_model(INDIVIDUAL, model_name, CORES_PER_SESION, MODEL, FOLDS, df_exmodel, error_type, max_features,
+                       round_prediction = False, fold_workers = 1, race_threshold = None, race_min_folds = None,
+                       fidelity = None):
+    """
+    Drop-in replacement of utils_model_genetic.score_model for the linear, bayesridge and
+    elasticnet wrappers of intramodel_hyperparameters_regressor. Instead of fitting the
+    wrapper on a pandas frame per fold, the coefficients are solved on the subsystem of the
+    precomputed Gram blocks (build_gram_store, shared in FOLDS["gram"], see fold_gram)
+    for the columns of the individual, with the params of MODEL["model_class"].model.
+    Only the test predictions touch the data. Racing works as in score_model; the "rows"
+    and "estimators" of fidelity are ignored since a solve is already cheap. Estimators
+    without intercept are not shift invariant (see build_gram_store) and are scored by
+    score_model.
+    """
+    if not MODEL["model_class"].model.get_params().get("fit_intercept", True):
+        return utils_model_genetic.score_model(INDIVIDUAL, model_name, CORES_PER_SESION, MODEL, FOLDS, df_exmodel,
+                                               error_type, max_features, round_prediction, fold_workers,
+                                               race_threshold, race_min_folds, fidelity)
+    baseline_features = INDIVIDUAL["baseline_features"]
+    exmodel_features  = INDIVIDUAL["exmodel_features"]
+    if df_exmodel:
+        total_features = len(baseline_features) + len(exmodel_features)
+    else:
+        total_features = len(baseline_features)
+    fidelity = fidelity or dict()
+    folds = FOLDS["folds"][:fidelity.get("folds", len(FOLDS["folds"]))]
+
+    errors = list()
+    if total_features > max_features:
+        logger.warning("model not evaluated, number of features bigger than max_features: %s", total_features)
+        errors = [1000000000000000000000000000000000000]*len(folds)
+    else:
+        GRAM = fold_gram(FOLDS)
+        positions = [0] + [1 + column for column in utils_model_genetic.feature_columns(FOLDS, INDIVIDUAL, df_exmodel)]
+        subsystem = np.ix_(positions, positions)
+        estimator = MODEL["model_class"].model
+
+        for test_fold in folds:
+            TRAIN = GRAM["train"][test_fold]
+            coef = solve_linear(estimator, TRAIN["gram"][subsystem], TRAIN["xy"][positions], TRAIN["yy"])
+            test_rows  = FOLDS["plan"][test_fold]["test"]
+            prediction = design_matrix(FOLDS, test_rows, positions, GRAM["shift"]) @ coef + GRAM["y_shift"]
+            prediction[prediction < 0] = 0
+            errors.append(utils_model_genetic.error_function(FOLDS["y"][test_rows], prediction))
+            if utils_model_genetic.lost_race(errors, len(folds), total_features, race_threshold, race_min_folds):
+                break
+
+    score =  - (np.sum(errors)/len(errors)) - total_features*.00001
+    genoma_solutions = utils_model_genetic.solution_record(INDIVIDUAL, score)
+    genoma_solutions["folds_evaluated"] = len(errors)
+    genoma_solutions["raced"] = len(errors) < len(FOLDS["folds"])
+    return genoma_solutions
+
+
+def solve_linear(estimator, gram, xy, yy):
+    """
+    Coefficients of estimator on the Gram subsystem gram, xy, yy (intercept in position 0)
+    of the shifted data of build_gram_store. The intercept is fitted by centering, as
+    sklearn does, so it is never penalized and the shift doesn't change the model.
+    Returns [intercept, coef...] of the shifted design matrix and target.
+    """
+    n_samples = gram[0, 0]
+    mean_x = gram[0, 1:]/n_samples
+    mean_y = xy[0]/n_samples
+    G = gram[1:, 1:] - n_samples*np.outer(mean_x, mean_x)
+    q = xy[1:] - n_samples*mean_x*mean_y
+    yy = yy - n_samples*mean_y**2
+
+    if len(q) == 0:
+        coef = np.zeros(0)
+    elif isinstance(estimator, BayesianRidge):
+        coef = bayesian_ridge_coef(G, q, yy, n_samples, estimator.get_params())
+    elif isinstance(estimator, ElasticNet):
+        coef = elastic_net_coef(G, q, yy, n_samples, estimator.get_params())
+    else:
+        coef = np.linalg.lstsq(G, q, rcond = None)[0]
+    return np.concatenate([[mean_y - mean_x @ coef], coef])
+
+
+def bayesian_ridge_coef(G, q, yy, n_samples, params):
+    """
+    Evidence maximization of sklearn.linear_model.BayesianRidge written over the centered
+    Gram matrix G = X'X, q = X'y, yy = y'y: the eigenvalues of G replace the singular
+    values of X and the residual sum of squares is yy - 2 coef'q + coef'G coef.
+    """
+    eps = np.finfo(np.float64).eps
+    eigen_vals, eigen_vecs = np.linalg.eigh(G)
+    eigen_vals = np.maximum(eigen_vals, 0)
+    projected = eigen_vecs.T @ q
+    alpha_ = params.get("alpha_init") or 1/(yy/n_samples + eps)
+    lambda_ = params.get("lambda_init") or 1.
+    n_iter = [value for value in [params.get("n_iter"), params.get("max_iter"), 300] if isinstance(value, int)][0]
+
+    def update_coef(alpha_, lambda_):
+        coef = eigen_vecs @ (projected/(eigen_vals + lambda_/alpha_))
+        rmse = max(yy - 2*coef @ q + coef @ G @ coef, 0)
+        return coef, rmse
+
+    coef_old = None
+    for iteration in range(n_iter):
+        coef, rmse = update_coef(alpha_, lambda_)
+        gamma_ = np.sum((alpha_*eigen_vals)/(lambda_ + alpha_*eigen_vals))
+        lambda_ = (gamma_ + 2*params["lambda_1"])/(np.sum(coef**2) + 2*params["lambda_2"])
+        alpha_ = (n_samples - gamma_ + 2*params["alpha_1"])/(rmse + 2*params["alpha_2"])
+        if coef_old is not None and np.sum(np.abs(coef_old - coef)) < params["tol"]:
+            break
+        coef_old = coef
+    coef, rmse = update_coef(alpha_, lambda_)
+    return coef
+
+
+def elastic_net_coef(G, q, yy, n_samples, params):
+    """
+    Cyclic coordinate descent of sklearn.linear_model.ElasticNet over the centered Gram
+    matrix G = X'X, q = X'y, yy = y'y, stopped with the same duality gap criterion.
+    """
+    l1_reg = params["alpha"]*params["l1_ratio"]*n_samples
+    l2_reg = params["alpha"]*(1 - params["l1_ratio"])*n_samples
+    tol = params["tol"]*yy
+    coef = np.zeros(len(q))
+    H = np.zeros(len(q))  #G @ coef
+    diagonal = np.diag(G)
+    for iteration in range(params["max_iter"]):
+        coef_max = 0
+        d_coef_max = 0
+        for j in range(len(q)):
+            if diagonal[j] == 0:
+                continue
+            coef_j = coef[j]
+            tmp = q[j] - H[j] + diagonal[j]*coef_j
+            new_coef_j = np.sign(tmp)*max(abs(tmp) - l1_reg, 0)/(diagonal[j] + l2_reg)
+            if new_coef_j != coef_j:
+                H += G[:, j]*(new_coef_j - coef_j)
+                coef[j] = new_coef_j
+            d_coef_max = max(d_coef_max, abs(new_coef_j - coef_j))
+            coef_max = max(coef_max, abs(new_coef_j))
+
+        if coef_max == 0 or d_coef_max/coef_max < params["tol"] or iteration == params["max_iter"] - 1:
+            q_dot_coef = coef @ q
+            R_norm2 = yy - 2*q_dot_coef + coef @ H
+            dual_norm_XtA = np.max(np.abs(q - H - l2_reg*coef))
+            if dual_norm_XtA > l1_reg:
+                const = l1_reg/dual_norm_XtA
+                gap = .5*(R_norm2 + R_norm2*const**2)
+            else:
+                const = 1.
+                gap = R_norm2
+            gap += l1_reg*np.sum(np.abs(coef)) - const*(yy - q_dot_coef) + .5*l2_reg*(1 + const**2)*(coef @ coef)
+            if gap < tol:
+                break
+    return coef
+
+
+def score_linear_population(INDIVIDUALS, model_name, CORES_PER_SESION, MODEL, FOLDS, df_exmodel, error_type, max_features,
+                            round_prediction = False, fold_workers = 1, race_threshold = None, race_min_folds = None,
+                            fidelity = None):
+    """
+    Batched score_linear_model: scores the list INDIVIDUALS at once and returns their
+    genoma_solutions in the same order. For every fold the Gram subsystems of the
+    individuals are gathered into a padded (B, k, k) stack (see batch_coef) and the test
+    predictions of the whole batch are a single product of the test design matrix with
+    the (columns, B) matrix of coefficients. Individuals that lose the race are dropped
+    from the next folds. Estimators without intercept are scored one by one.
+    """
+    if not MODEL["model_class"].model.get_params().get("fit_intercept", True):
+        return [score_linear_model(INDIVIDUAL, model_name, CORES_PER_SESION, MODEL, FOLDS, df_exmodel, error_type,
+                                   max_features, round_prediction, fold_workers, race_threshold, race_min_folds,
+                                   fidelity) for INDIVIDUAL in INDIVIDUALS]
+    fidelity = fidelity or dict()
+    folds = FOLDS["folds"][:fidelity.get("folds", len(FOLDS["folds"]))]
+    GRAM = fold_gram(FOLDS)
+    estimator = MODEL["model_class"].model
+
+    positions = list()
+    total_features = np.zeros(len(INDIVIDUALS), dtype = int)
+    errors = [list() for INDIVIDUAL in INDIVIDUALS]
+    for i, INDIVIDUAL in enumerate(INDIVIDUALS):
+        individual_positions = [0] + [1 + column for column in utils_model_genetic.feature_columns(FOLDS, INDIVIDUAL,
+                                                                                                  df_exmodel)]
+        positions.append(individual_positions)
+        total_features[i] = len(individual_positions) - 1
+        if total_features[i] > max_features:
+            logger.warning("model not evaluated, number of features bigger than max_features: %s", total_features[i])
+            errors[i] = [1000000000000000000000000000000000000]*len(folds)
+    active = [i for i in range(len(INDIVIDUALS)) if total_features[i] <= max_features]
+
+    for test_fold in folds:
+        if len(active) == 0:
+            break
+        TRAIN = GRAM["train"][test_fold]
+        coefs = batch_coef(estimator, TRAIN, [positions[i] for i in active])
+
+        used = np.unique(np.concatenate([positions[i] for i in active]))
+        column = dict([(position, j) for j, position in enumerate(used)])
+        W = np.zeros((len(used), len(active)))
+        for b, i in enumerate(active):
+            W[[column[position] for position in positions[i]], b] = coefs[b]
+        test_rows = FOLDS["plan"][test_fold]["test"]
+        predictions = design_matrix(FOLDS, test_rows, used, GRAM["shift"]) @ W + GRAM["y_shift"]
+        predictions[predictions < 0] = 0
+        fold_errors = np.abs(FOLDS["y"][test_rows][:, None] - predictions).mean(axis = 0)
+
+        still_active = list()
+        for b, i in enumerate(active):
+            errors[i].append(fold_errors[b])
+            if not utils_model_genetic.lost_race(errors[i], len(folds), total_features[i], race_threshold, race_min_folds):
+                still_active.append(i)
+        active = still_active
+
+    SOLUTIONS = list()
+    for i, INDIVIDUAL in enumerate(INDIVIDUALS):
+        score =  - (np.sum(errors[i])/len(errors[i])) - total_features[i]*.00001
+        genoma_solutions = utils_model_genetic.solution_record(INDIVIDUAL, score)
+        genoma_solutions["folds_evaluated"] = len(errors[i])
+        genoma_solutions["raced"] = len(errors[i]) < len(FOLDS["folds"])
+        SOLUTIONS.append(genoma_solutions)
+    return SOLUTIONS
+
+
+def batch_coef(estimator, TRAIN, positions, max_elements = 20000000):
+    """
+    Coefficients [intercept, coef...] of every list of Gram positions in positions. For
+    least squares the centered subsystems are stacked in chunks of at most max_elements
+    numbers, padded with the identity up to the largest one, and solved with a single
+    batched pseudo-inverse (the same minimum norm solution as lstsq); the padding gets
+    zero coefficients. BayesianRidge and ElasticNet are solved one by one with solve_linear.
+    """
+    if isinstance(estimator, (BayesianRidge, ElasticNet)):
+        return [solve_linear(estimator, TRAIN["gram"][np.ix_(individual, individual)], TRAIN["xy"][individual], TRAIN["yy"])
+                for individual in positions]
+
+    coefs = list()
+    k_max = max([len(individual) for individual in positions])
+    chunk = max(1, int(max_elements/k_max**2))
+    for start in range(0, len(positions), chunk):
+        batch = positions[start:start + chunk]
+        index = np.zeros((len(batch), k_max), dtype = int)
+        mask  = np.zeros((len(batch), k_max))
+        for b, individual in enumerate(batch):
+            index[b, :len(individual)] = individual
+            mask[b, :len(individual)]  = 1
+        mask[:, 0] = 0
+
+        gram = TRAIN["gram"][index[:, :, None], index[:, None, :]]
+        xy   = TRAIN["xy"][index]
+        n_samples = TRAIN["gram"][0, 0]
+        mean_x = gram[:, 0, :]/n_samples*mask
+        mean_y = TRAIN["xy"][0]/n_samples
+        G = (gram - n_samples*mean_x[:, :, None]*mean_x[:, None, :])*mask[:, :, None]*mask[:, None, :]
+        G += np.eye(k_max)*(1 - mask)[:, :, None]
+        q = (xy - n_samples*mean_x*mean_y)*mask
+
+        coef = (np.linalg.pinv(G) @ q[:, :, None])[:, :, 0]*mask
+        coef[:, 0] = mean_y - np.sum(mean_x*coef, axis = 1)
+        coefs += [coef[b, :len(individual)] for b, individual in enumerate(batch)]
+    return coefs
@@ -10,62 +10,115 @@ import time
 from sklearn import linear_model
 import pickle
 import threading
+import queue
+import os
+import signal
+import utils_fold_store
+import utils_fitness_cache
+import concurrent.futures
+import logging
+import json
+
+logger = logging.getLogger(__name__)
 
 #MODEL= "test"; len_population = 0; len_pc = 0; len_pm= 0 ; N_WORKERS =16
 
 
 
-def generate_model_population(columns_list, NEURONAL_SOLUTIONS, n_col, N, max_features):
+def generate_model_population(columns_list, NEURONAL_SOLUTIONS, n_col, N, max_features, GENE_MASK = None):
+    """
+    Generates N random individuals. The chromosomes of the whole population are built as a
+    single (N, GENLONG) uint8 matrix of 0/1 genes:
+        baseline_features bits  +  exmodel_features bits
+    and every individual keeps its row in INDIVIDUAL["CHROMOSOME"] (see set_chromosome).
+    The chromosomes are canonicalized with GENE_MASK (see gene_mask) when given.
+    """
     POPULATION = dict()
     baseline_all_features = columns_list
     exmodel_features = get_exmodel_features( NEURONAL_SOLUTIONS, n_col )
+    n_baseline = len(baseline_all_features)
+    CHROMOSOMES = np.zeros((N, n_baseline + len(exmodel_features)), dtype = np.uint8)
 
     for i in range(N):
-        POPULATION[i] = dict()
-
-        baseline_features_selected = list()
-        baseline_features_chromosome = "0"*len(baseline_all_features)
         n_total_selected_features = random.randint(0, max_features)
-        n_baseline_selected_features = random.randint(0, len(baseline_all_features))
+        n_baseline_selected_features = random.randint(0, n_baseline)
 
         if n_baseline_selected_features > n_total_selected_features:
             n_baseline_selected_features =  n_total_selected_features
 
-        selected_features = random.sample(range(len(baseline_all_features)), n_baseline_selected_features)
-
-        for feature_position in selected_features:
-            baseline_features_selected.append(baseline_all_features[feature_position])
-            baseline_features_chromosome = list(baseline_features_chromosome)
-            baseline_features_chromosome[feature_position] = "1"
-            baseline_features_chromosome = "".join(baseline_features_chromosome)
-
-        POPULATION[i]["baseline_features"] =  baseline_features_selected
-        POPULATION[i]["baseline_features_chromosome"] = baseline_features_chromosome
+        selected_features = random.sample(range(n_baseline), n_baseline_selected_features)
+        CHROMOSOMES[i, selected_features] = 1
 
-        exmodel_features_selected = list()
         if len(exmodel_features) >0: #Not layer N_0
-            exmodel_features_chromosome = "0"*len(exmodel_features)
             n_exmodel_selected_features = n_total_selected_features - n_baseline_selected_features
             if n_exmodel_selected_features > len(exmodel_features):
                 n_exmodel_selected_features =  len(exmodel_features) -1 
             selected_features = random.sample(range(len(exmodel_features)), n_exmodel_selected_features)
-            for feature_position in selected_features:
-                exmodel_features_selected.append(exmodel_features[feature_position])
-                exmodel_features_chromosome = list(exmodel_features_chromosome)
-                exmodel_features_chromosome[feature_position] = "1"
-                exmodel_features_chromosome = "".join(exmodel_features_chromosome)
-        else:
-            exmodel_features_chromosome = ""
-            exmodel_features_selected = []
+            CHROMOSOMES[i, n_baseline + np.array(selected_features, dtype = int)] = 1
 
-        POPULATION[i]["exmodel_features"] =  exmodel_features_selected
-        POPULATION[i]["exmodel_features_chromosome"] = exmodel_features_chromosome
-        POPULATION[i]["GENOMA"] = POPULATION[i]["baseline_features_chromosome"] +""+ POPULATION[i]["exmodel_features_chromosome"]
-        POPULATION[i]["SCORE"]  = np.nan
+    if GENE_MASK is not None:
+        CHROMOSOMES &= GENE_MASK
+    for i in range(N):
+        POPULATION[i] = dict()
+        set_chromosome(POPULATION[i], CHROMOSOMES[i], n_baseline)
+    change_fenotype_using_genoma(POPULATION, NEURONAL_SOLUTIONS, n_col, columns_list)
     return POPULATION
 
+
+def gene_mask(columns_list, NEURONAL_SOLUTIONS, n_col, df_exmodel = None):
+    """
+    uint8 mask of the genes that decode to a feature the model can use: every baseline
+    gene, and the exmodel genes whose neuron output is in every fold of df_exmodel (none
+    without df_exmodel). Chromosomes are canonicalized with it, so genomas that only
+    differ in genes pointing at unavailable neurons are the same GENOMA and the same
+    fenotype, and are fitted once.
+    """
+    exmodel_features = get_exmodel_features(NEURONAL_SOLUTIONS, n_col)
+    available = set()
+    if df_exmodel:
+        folds = [fold for fold in df_exmodel.keys() if fold != "all_data"]
+        available = set.intersection(*[set(df_exmodel[fold].columns) for fold in folds])
+    exmodel_mask = [int(feature in available) for feature in exmodel_features]
+    return np.array([1]*len(columns_list) + exmodel_mask, dtype = np.uint8)
+
+
+def genoma_key(chromosome):
+    """
+    Bit-packs a 0/1 chromosome into bytes. The bytes are the GENOMA of an individual
+    and the key used in SOLUTIONS.
+    """
+    return np.packbits(chromosome).tobytes()
+
+
+def set_chromosome(INDIVIDUAL, chromosome, n_baseline):
+    """
+    Stores chromosome (uint8 array of 0/1 genes) in INDIVIDUAL together with its GENOMA and
+    the baseline/exmodel parts of the chromosome, which are views of the same array.
+    INDIVIDUAL["SCORED"] and INDIVIDUAL["SCORE"] are reset, they belong to the previous
+    chromosome. The fenotype must be updated afterwards with change_fenotype_using_genoma.
+    """
+    INDIVIDUAL["CHROMOSOME"] = chromosome
+    INDIVIDUAL["GENOMA"]     = genoma_key(chromosome)
+    INDIVIDUAL["SCORED"]     = False
+    INDIVIDUAL["SCORE"]      = np.nan
+    INDIVIDUAL["baseline_features_chromosome"] = chromosome[:n_baseline]
+    INDIVIDUAL["exmodel_features_chromosome"]  = chromosome[n_baseline:]
+
+
+def population_chromosomes(POPULATION):
+    """
+    Returns the chromosomes of POPULATION as a (N, GENLONG) uint8 matrix, one row per
+    individual in key order.
+    """
+    return np.vstack([POPULATION[individual]["CHROMOSOME"] for individual in POPULATION.keys()])
+
+
 def solve_genetic_algorithm(N, PC, PM, N_WORKERS, MAX_ITERATIONS, MODEL, NEURONAL_SOLUTIONS, n_col, columns_list, 
-    df_kfolded, df_exmodel = None, max_features=1000, round_prediction= False, parallel_execution = False ):
+    df_kfolded, df_exmodel = None, max_features=1000, round_prediction= False, parallel_execution = False,
+    fitness_cache = None, fold_workers = 1, race_min_folds = None, successive_halving = None,
+    surrogate = None, islands = None, migration_interval = 5, migration_size = 2, migration = None,
+    steady_state = False, checkpoint = None, checkpoint_interval = 1, resume_from = None,
+    debug_checks = False ):
     """
     Solve a Genetic Algorithm with 
         len(genoma)               == GENLONG, 
@@ -74,83 +127,579 @@ def solve_genetic_algorithm(N, PC, PM, N_WORKERS, MAX_ITERATIONS, MODEL, NEURONA
         Crossover probability     == PC
         Max number of iterations  == MAX_ITERATIONS
         Cost function             == MODEL
+    fitness_cache is the path of a SQLite file (see utils_fitness_cache) where the scores
+    are kept between runs; genomas found in it are not fitted again.
+    fold_workers > 1 fits the folds of one individual concurrently (see score_model).
+    race_min_folds enables racing: after race_min_folds folds an offspring stops being
+    evaluated when its partial score is already worse than the N-th best parent.
+    successive_halving is a list of cheap fidelity rounds run on the new genomas before the
+    full K-fold score (see halving_solve), e.g.
+        [{"folds": 1, "rows": .25, "estimators": .25, "promote": .5}]
+    scores every new genoma on one fold with a quarter of the training rows and a quarter
+    of the estimators, and only the best half is then scored on every fold.
+    surrogate enables the pre-screening of the offspring (see surrogate_screen), e.g.
+        {"keep": .5, "explore": .1, "min_solutions": 50}
+    islands = K runs K populations of N individuals in K processes (see solve_islands);
+    every migration_interval generations each island sends its migration_size best
+    individuals to the next one. migration is the queues of an island, set by island_loop.
+    With parallel_execution every island starts its own pool of N_WORKERS workers, i.e.
+    K*(N_WORKERS + 1) processes in total. islands can't be combined with steady_state,
+    checkpoint or resume_from.
+    steady_state = True replaces the generations by the asynchronous scheduler of
+    steady_state_solve (requires parallel_execution; there are no generations to
+    checkpoint, so it can't be combined with checkpoint or resume_from).
+    checkpoint is the path where the state of the run is saved every checkpoint_interval
+    generations (see save_checkpoint); resume_from is a checkpoint to continue a run from,
+    with the same arguments it was started with.
+    debug_checks = True runs the full fenotype/chromosome scans of the population and of
+    SOLUTIONS and the fold matrix check of the population (test_fold_matrix_POPULATION)
+    every generation; otherwise only the O(1) check of solve_population is done.
     """
-
-    print("\n\nTEST KFOLDED MEANS: ")
-    for fold in df_kfolded.keys():
-        print("FOLD", np.mean(df_kfolded[fold]["y"]))
+    if steady_state and not parallel_execution:
+        raise ValueError("steady_state requires parallel_execution = True")
+    if steady_state and (checkpoint is not None or resume_from is not None):
+        raise ValueError("steady_state can't be combined with checkpoint or resume_from")
+    if islands:
+        unsupported = [name for name, value in [("steady_state", steady_state), ("checkpoint", checkpoint),
+                                                ("resume_from", resume_from)] if value]
+        if len(unsupported) > 0:
+            raise ValueError("islands can't be combined with {}".format(unsupported))
+        return solve_islands(islands, migration_interval, migration_size, N, PC, PM, N_WORKERS, MAX_ITERATIONS,
+                             MODEL, NEURONAL_SOLUTIONS, n_col, columns_list, df_kfolded, df_exmodel = df_exmodel,
+                             max_features = max_features, round_prediction = round_prediction,
+                             parallel_execution = parallel_execution, fitness_cache = fitness_cache,
+                             fold_workers = fold_workers, race_min_folds = race_min_folds,
+                             successive_halving = successive_halving, surrogate = surrogate,
+                             debug_checks = debug_checks)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for fold in df_kfolded.keys():
+            logger.debug("FOLD %s mean y: %s", fold, np.mean(df_kfolded[fold]["y"]))
 
     STILL_CHANGE = True 
     still_change_count = 0 
+    n_iter = 0 
 
-    if parallel_execution:
-        LOCK = multiprocessing.Lock()
-        manager_solutions = multiprocessing.Manager()
-        SOLUTIONS = manager_solutions.dict()
-    else: 
-        SOLUTIONS = dict()
-
-    POPULATION_X = generate_model_population(columns_list, NEURONAL_SOLUTIONS, n_col, N, max_features)
+    SOLUTIONS = dict()
 
-    if parallel_execution:
-        print("\n\n----------------PARALLEL SOLVE--------------")
-        POPULATION_X = parallel_solve(POPULATION_X, SOLUTIONS, LOCK, N_WORKERS, MODEL,
-                                      df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
+    GENE_MASK = gene_mask(columns_list, NEURONAL_SOLUTIONS, n_col, df_exmodel)
+    if resume_from is not None:
+        POPULATION_X, SOLUTIONS, n_iter, still_change_count = load_checkpoint(resume_from, NEURONAL_SOLUTIONS,
+                                                                              n_col, columns_list, GENE_MASK)
+        STILL_CHANGE = still_change_count < 10
     else:
-        print("\n\n--------------SEQUENTIAL SOLVE----------------")
-        POPULATION_X = sequential_solve(POPULATION_X, SOLUTIONS, N_WORKERS, MODEL,
-                                      df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
+        POPULATION_X = generate_model_population(columns_list, NEURONAL_SOLUTIONS, n_col, N, max_features, GENE_MASK)
+
+    FOLD_STORE = utils_fold_store.build_fold_store(df_kfolded, shared = parallel_execution, df_exmodel = df_exmodel)
+    SOLVER = dict()
+    SOLVER["model"]            = MODEL
+    SOLVER["n_workers"]        = N_WORKERS
+    SOLVER["df_exmodel"]       = df_exmodel
+    SOLVER["error_type"]       = "MSE"
+    SOLVER["max_features"]     = max_features
+    SOLVER["round_prediction"] = round_prediction
+    SOLVER["fold_workers"]     = fold_workers
+    SOLVER["race_min_folds"]   = race_min_folds
+    SOLVER["halving"]          = successive_halving
+    SOLVER["surrogate"]        = build_surrogate(surrogate)
+    SOLVER["gene_mask"]        = GENE_MASK
+    SOLVER["folds"]            = utils_fold_store.attach_fold_store(FOLD_STORE)
+    SOLVER["pool"]             = None
+    SOLVER["fitness_cache"]    = None
+    try:
+        if "gram_function" in MODEL:
+            FOLD_STORE["gram"] = SOLVER["folds"]["gram"] = MODEL["gram_function"](SOLVER["folds"])
+        if fitness_cache is not None:
+            SOLVER["fitness_cache"] = utils_fitness_cache.open_fitness_cache(fitness_cache, MODEL,
+                                      SOLVER["folds"], df_exmodel, SOLVER["error_type"], max_features)
+        if parallel_execution:
+            SOLVER["pool"] = start_worker_pool(N_WORKERS, MODEL, FOLD_STORE, df_exmodel,
+                                               SOLVER["error_type"], max_features, round_prediction,
+                                               fold_workers, race_min_folds)
+
+        if resume_from is None:
+            POPULATION_X = solve_population(POPULATION_X, SOLUTIONS, SOLVER)
+
+            if debug_checks:
+                test_fenotype_chromosome_POPULATION(POPULATION_X, NEURONAL_SOLUTIONS, columns_list, n_col)
+                test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_list, n_col)
+                test_fold_matrix_POPULATION(POPULATION_X, SOLVER["folds"], df_exmodel)
+
+            POPULATION_X = sort_population(POPULATION_X)
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, POPULATION_X, SOLUTIONS, n_iter, still_change_count)
+        if steady_state:
+            POPULATION_X = steady_state_solve(POPULATION_X, SOLUTIONS, SOLVER, NEURONAL_SOLUTIONS, columns_list,
+                                              n_col, N, PC, PM, MAX_ITERATIONS)
+            STILL_CHANGE = False
+        while (n_iter <= MAX_ITERATIONS) & STILL_CHANGE:
+            generation_start = (time.time(), len(SOLUTIONS), cache_hits(SOLVER))
+            columns_list_copy = columns_list.copy()
+            POPULATION_Y = cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list_copy, n_col, N, PC, PM, GENE_MASK)
+            #print("\n\n******************** baseline_features after cross_mutate")
+            #test_baseline_xy(POPULATION_Y, POPULATION_X)
+            if debug_checks:
+                test_fenotype_chromosome_POPULATION(POPULATION_Y, NEURONAL_SOLUTIONS, columns_list, n_col)
+
+            #RESELECT parallel_solve
+            POPULATION_Y = solve_population(POPULATION_Y, SOLUTIONS, SOLVER,
+                                            race_threshold = POPULATION_X[N-1]["SCORE"], screen = True)
+            #print("\n\ntest_baseline_xy 1")
+            #test_baseline_xy(POPULATION_X, POPULATION_Y)
+            if debug_checks:
+                test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_list, n_col)
+                test_fold_matrix_POPULATION(POPULATION_Y, SOLVER["folds"], df_exmodel)
+            #print("\n\ntest_baseline_xy 2")
+            #test_baseline_xy(POPULATION_X, POPULATION_Y)
 
-    print("\n\n1 -----------------TEST: fenotye in SOLUTIONS acordingly to genoma")
-    test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_list, n_col)
+            POPULATION_X = sort_population(POPULATION_X)
+            POPULATION_Y = sort_population(POPULATION_Y)
+            POPULATION_X = select_topn(POPULATION_X, POPULATION_Y, N)
+
+            #print("\n\ntest_baseline_xy 3")
+            #test_baseline_xy(POPULATION_X, POPULATION_X)
+
+            equal_individuals, max_score = population_summary(POPULATION_X)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("%s", json.dumps(generation_summary(n_iter, POPULATION_X, SOLUTIONS, SOLVER, generation_start)))
+
+            n_iter += 1
+            if migration is not None and n_iter % migration["interval"] == 0:
+                POPULATION_X = migrate(POPULATION_X, SOLUTIONS, migration)
+            if equal_individuals >= len(POPULATION_X.keys())*.8:
+                still_change_count +=1 
+                #print("SAME ** {} ".format(still_change_count))
+                if still_change_count >= 10:
+                    logger.info("GA Solved: N: %s PC: %s PM: %s N_WORKERS: %s MAX_ITERATIONS: %s MODEL: %s",
+                                N, PC, PM, N_WORKERS, MAX_ITERATIONS, MODEL["model_name"])
+                    STILL_CHANGE = False
+            if checkpoint is not None and n_iter % checkpoint_interval == 0:
+                save_checkpoint(checkpoint, POPULATION_X, SOLUTIONS, n_iter, still_change_count)
+    finally:
+        if SOLVER["pool"] is not None:
+            stop_worker_pool(SOLVER["pool"])
+        if SOLVER["fitness_cache"] is not None:
+            utils_fitness_cache.close_fitness_cache(SOLVER["fitness_cache"])
+        utils_fold_store.detach_fold_store(SOLVER["folds"])
+        utils_fold_store.release_fold_store(FOLD_STORE)
 
-    POPULATION_X = sort_population(POPULATION_X)
-    n_iter = 0 
-    while (n_iter <= MAX_ITERATIONS) & STILL_CHANGE:
-        columns_list_copy = columns_list.copy()
-        POPULATION_Y = cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list_copy, n_col, N, PC, PM)
-        #print("\n\n******************** baseline_features after cross_mutate")
-        #test_baseline_xy(POPULATION_Y, POPULATION_X)
+    return POPULATION_X, SOLUTIONS
 
-        #RESELECT parallel_solve
-        if parallel_execution:
-            print("\n\n----------------PARALLEL SOLVE--------------\n POPULATION_X length: {} POPULATION_Y length{}".format(len(POPULATION_X.keys()), len(POPULATION_Y.keys())))
-            POPULATION_X = parallel_solve(POPULATION_X, SOLUTIONS, LOCK, N_WORKERS, MODEL, 
-                           df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
-            POPULATION_Y = parallel_solve(POPULATION_Y, SOLUTIONS, LOCK, N_WORKERS, MODEL,
-                           df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
 
-        else:
-            print("\n\n--------------SEQUENTIAL SOLVE----------------\n POPULATION_X: {} POPULATION_Y {}".format(len(POPULATION_X.keys()), len(POPULATION_Y.keys())))
-            POPULATION_X = sequential_solve(POPULATION_X, SOLUTIONS, N_WORKERS, MODEL, 
-                           df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
-            POPULATION_Y = sequential_solve(POPULATION_Y, SOLUTIONS, N_WORKERS, MODEL,
-                           df_kfolded, df_exmodel, "MSE", max_features, round_prediction)
-            #print("\n\ntest_baseline_xy 1")
-            #test_baseline_xy(POPULATION_X, POPULATION_Y)
-        print("\n\n2 -----------------TEST: fenotye in SOLUTIONS acordingly to genoma")
-        test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_list, n_col)
-        #print("\n\ntest_baseline_xy 2")
-        #test_baseline_xy(POPULATION_X, POPULATION_Y)
+def save_checkpoint(path, POPULATION_X, SOLUTIONS, n_iter, still_change_count):
+    """
+    Saves the state needed to continue a run after generation n_iter: the chromosomes of
+    POPULATION_X as a (N, GENLONG) uint8 matrix, their scores, SOLUTIONS, the convergence
+    counter and the state of random and np.random. The file is written next to path and
+    renamed over it, so a crash while saving never leaves a broken checkpoint.
+    """
+    CHECKPOINT = dict()
+    CHECKPOINT["chromosomes"] = population_chromosomes(POPULATION_X)
+    CHECKPOINT["scores"]      = np.array([POPULATION_X[key]["SCORE"] for key in POPULATION_X.keys()], dtype = float)
+    CHECKPOINT["scored"]      = np.array([POPULATION_X[key]["SCORED"] for key in POPULATION_X.keys()], dtype = bool)
+    CHECKPOINT["solutions"]   = SOLUTIONS
+    CHECKPOINT["n_iter"]      = n_iter
+    CHECKPOINT["still_change_count"] = still_change_count
+    CHECKPOINT["random_state"]    = random.getstate()
+    CHECKPOINT["np_random_state"] = np.random.get_state()
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(CHECKPOINT, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path, NEURONAL_SOLUTIONS, n_col, columns_list, GENE_MASK):
+    """
+    Reads a checkpoint written by save_checkpoint, restores the random states and returns
+    POPULATION_X (fenotypes decoded again), SOLUTIONS, n_iter and still_change_count.
+    """
+    with open(path, "rb") as f:
+        CHECKPOINT = pickle.load(f)
+    if CHECKPOINT["chromosomes"].shape[1] != len(GENE_MASK):
+        raise ValueError("Checkpoint chromosomes have {} genes, the current problem has {}".format(
+                          CHECKPOINT["chromosomes"].shape[1], len(GENE_MASK)))
+
+    POPULATION_X = dict()
+    for i, chromosome in enumerate(CHECKPOINT["chromosomes"]):
+        POPULATION_X[i] = dict()
+        set_chromosome(POPULATION_X[i], chromosome, len(columns_list))
+        POPULATION_X[i]["SCORE"]  = CHECKPOINT["scores"][i]
+        POPULATION_X[i]["PROB"]   = CHECKPOINT["scores"][i] / len(CHECKPOINT["scores"])
+        POPULATION_X[i]["SCORED"] = bool(CHECKPOINT["scored"][i])
+    change_fenotype_using_genoma(POPULATION_X, NEURONAL_SOLUTIONS, n_col, columns_list)
+
+    random.setstate(CHECKPOINT["random_state"])
+    np.random.set_state(CHECKPOINT["np_random_state"])
+    return POPULATION_X, CHECKPOINT["solutions"], CHECKPOINT["n_iter"], CHECKPOINT["still_change_count"]
+
+
+def solve_islands(islands, migration_interval, migration_size, *args, **kwargs):
+    """
+    Island model: islands processes run solve_genetic_algorithm(*args, **kwargs) on their
+    own population, each one with its own random seed, and exchange their best individuals
+    through a ring of queues (see migrate) without waiting for each other. Returns the N
+    best individuals of all the islands and the union of their SOLUTIONS. The islands are
+    not daemonic, so each one can start its own worker pool (parallel_execution); when an
+    island fails, or its process dies without reporting, the others are stopped with
+    SIGTERM (see island_loop).
+    """
+    N = args[0]
+    seed = np.random.randint(0, 2**31 - islands)
+    QUEUES  = [multiprocessing.Queue() for island in range(islands)]
+    RESULTS = multiprocessing.Queue()
+    PROCESSES = list()
+    POPULATION_ALL = dict()
+    SOLUTIONS = dict()
+    try:
+        for island in range(islands):
+            MIGRATION = {"inbox": QUEUES[island], "outbox": QUEUES[(island + 1) % islands],
+                         "interval": migration_interval, "size": migration_size}
+            process = multiprocessing.Process( target = island_loop,
+                                               args = (island, seed + island, MIGRATION, RESULTS, args, kwargs, ))
+            process.start()
+            PROCESSES.append(process)
+
+        RUNNING = dict(enumerate(PROCESSES))
+        while len(RUNNING) > 0:
+            try:
+                island, island_population, island_solutions = RESULTS.get(timeout = 5)
+            except queue.Empty:
+                if not all([process.is_alive() for process in RUNNING.values()]) and RESULTS.empty():
+                    raise RuntimeError("An island process died while solving the genetic algorithm")
+                continue
+            RUNNING.pop(island)
+            if island_population is None:
+                raise RuntimeError("An island failed while solving the genetic algorithm")
+            for individual in island_population.values():
+                POPULATION_ALL[len(POPULATION_ALL)] = individual
+            SOLUTIONS.update(island_solutions)
+    except BaseException:
+        for process in PROCESSES:
+            process.terminate()
+        raise
+    finally:
+        for process in PROCESSES:
+            process.join()
+
+    POPULATION_ALL = sort_population(POPULATION_ALL)
+    POPULATION_X = dict()
+    for key in list(POPULATION_ALL.keys())[:N]:
+        POPULATION_X[key] = POPULATION_ALL[key]
+    return POPULATION_X, SOLUTIONS
+
 
-        POPULATION_X = sort_population(POPULATION_X)
-        POPULATION_Y = sort_population(POPULATION_Y)
-        POPULATION_X = select_topn(POPULATION_X, POPULATION_Y, N)
+def island_loop(island, seed, MIGRATION, RESULTS, args, kwargs):
+    """
+    Body of every island process of solve_islands. Sends (island, POPULATION_X, SOLUTIONS)
+    through RESULTS when it finishes, or (island, None, None) when it fails. SIGTERM exits through
+    exit_on_sigterm, so the finally of solve_genetic_algorithm still runs.
+    """
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    random.seed(seed)
+    np.random.seed(seed)
+    #Migrants left in the queue of a finished island must not block the exit.
+    MIGRATION["outbox"].cancel_join_thread()
+    try:
+        POPULATION_X, SOLUTIONS = solve_genetic_algorithm(*args, migration = MIGRATION, **kwargs)
+    except Exception:
+        traceback.print_exc()
+        POPULATION_X, SOLUTIONS = None, None
+    RESULTS.put((island, POPULATION_X, SOLUTIONS))
 
-        #print("\n\ntest_baseline_xy 3")
-        #test_baseline_xy(POPULATION_X, POPULATION_X)
 
-        equal_individuals, max_score = population_summary(POPULATION_X)
+def exit_on_sigterm(signum, frame):
+    """
+    SIGTERM handler of the island and neuron processes: raises SystemExit so the worker
+    pool is stopped and the fold store released on the way out.
+    """
+    raise SystemExit(1)
 
-        n_iter += 1
-        if equal_individuals >= len(POPULATION_X.keys())*.8:
-            still_change_count +=1 
-            #print("SAME ** {} ".format(still_change_count))
-            if still_change_count >= 10:
-                print("\n\n\nGA Solved: \n\tN: {}\n\tPC:{}, \n\tPM: {}\n\tN_WORKERS: {} \n\tMAX_ITERATIONS: {}\n\tMODEL: {}".format( N, PC, PM, N_WORKERS, MAX_ITERATIONS, MODEL ))
-                STILL_CHANGE = False
 
-    return POPULATION_X, SOLUTIONS
+def migrate(POPULATION_X, SOLUTIONS, MIGRATION):
+    """
+    Sends the MIGRATION["size"] best individuals of POPULATION_X (sorted, best first) with
+    their SOLUTIONS entry to the next island, and replaces the worst individuals with the
+    best migrants received so far. Never waits for the other islands.
+    """
+    keys = list(POPULATION_X.keys())
+    emigrants = [(POPULATION_X[key], SOLUTIONS[POPULATION_X[key]["GENOMA"]]) for key in keys[:MIGRATION["size"]]
+                 if POPULATION_X[key]["GENOMA"] in SOLUTIONS]
+    MIGRATION["outbox"].put(emigrants)
+
+    immigrants = list()
+    while True:
+        try:
+            immigrants += MIGRATION["inbox"].get_nowait()
+        except queue.Empty:
+            break
+    immigrants = sorted(immigrants, key = lambda migrant: -migrant[0]["SCORE"])[:MIGRATION["size"]]
+    for key, (INDIVIDUAL, genoma_solutions) in zip(reversed(keys), immigrants):
+        SOLUTIONS.setdefault(INDIVIDUAL["GENOMA"], genoma_solutions)
+        POPULATION_X[key] = INDIVIDUAL
+    if len(immigrants) > 0:
+        logger.debug("MIGRATION: %s individuals received", len(immigrants))
+    return sort_population(POPULATION_X)
+
+
+def steady_state_solve(POPULATION_X, SOLUTIONS, SOLVER, NEURONAL_SOLUTIONS, columns_list, n_col, N, PC, PM,
+                       MAX_ITERATIONS):
+    """
+    Asynchronous steady-state GA over the worker pool. There are always as many children
+    in flight as workers: every time a worker returns a score the child replaces the worst
+    individual of POPULATION_X when it is better, and two random parents of the current
+    population produce new children with cross_mutate, which are dispatched at once. No
+    worker waits for the slowest fit of a generation. Children whose genoma is already in
+    the population or in flight are dropped. The run stops after MAX_ITERATIONS*N children,
+    the same budget as the generational loop. successive_halving and surrogate don't apply.
+    """
+    POOL = SOLVER["pool"]
+    IN_FLIGHT = dict()
+    budget = MAX_ITERATIONS*N
+    produced = 0
+    received = 0
+    generation_start = (time.time(), len(SOLUTIONS), cache_hits(SOLVER))
+
+    def insert(CHILD):
+        keys = list(POPULATION_X.keys())
+        if CHILD["GENOMA"] in set([POPULATION_X[key]["GENOMA"] for key in keys]):
+            return
+        worst = keys[int(np.argmin([POPULATION_X[key]["SCORE"] for key in keys]))]
+        if CHILD["SCORE"] > POPULATION_X[worst]["SCORE"]:
+            POPULATION_X[worst] = CHILD
+
+    while True:
+        while len(IN_FLIGHT) < len(POOL["workers"]) and produced < budget:
+            parents = random.sample(list(POPULATION_X.keys()), 2)
+            PARENTS = {0: POPULATION_X[parents[0]], 1: POPULATION_X[parents[1]]}
+            CHILDREN = cross_mutate(PARENTS, NEURONAL_SOLUTIONS, columns_list.copy(), n_col, 2, PC, PM,
+                                    SOLVER["gene_mask"])
+            if SOLVER["fitness_cache"] is not None:
+                utils_fitness_cache.load_solutions(SOLVER["fitness_cache"], CHILDREN, SOLUTIONS)
+            for CHILD in CHILDREN.values():
+                produced += 1
+                genoma = CHILD["GENOMA"]
+                if genoma in SOLUTIONS:
+                    CHILD["SCORE"]  = SOLUTIONS[genoma]["score"]
+                    CHILD["SCORED"] = True
+                    insert(CHILD)
+                elif genoma not in IN_FLIGHT:
+                    worst_score = min([POPULATION_X[key]["SCORE"] for key in POPULATION_X.keys()])
+                    IN_FLIGHT[genoma] = CHILD
+                    POOL["tasks"].put(([CHILD], worst_score, None))
+
+        if len(IN_FLIGHT) == 0:
+            break
+        try:
+            genoma, genoma_solutions = POOL["results"].get(timeout = 5)
+        except queue.Empty:
+            if not all([worker.is_alive() for worker in POOL["workers"]]):
+                raise RuntimeError("A worker of the pool died while scoring the population")
+            continue
+        CHILD = IN_FLIGHT.pop(genoma)
+        if genoma_solutions is None:
+            logger.warning("GENOMA not found in SOLUTIONS after scoring")
+            continue
+        SOLUTIONS[genoma] = genoma_solutions
+        CHILD["SCORE"]  = genoma_solutions["score"]
+        CHILD["PROB"]   = CHILD["SCORE"] / N
+        CHILD["SCORED"] = True
+        insert(CHILD)
+        if SOLVER["fitness_cache"] is not None:
+            utils_fitness_cache.save_solutions(SOLVER["fitness_cache"], {0: CHILD}, SOLUTIONS)
+        received += 1
+        if received % N == 0:
+            population_summary(POPULATION_X)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("%s", json.dumps(generation_summary(received // N - 1, POPULATION_X, SOLUTIONS, SOLVER,
+                                                                generation_start)))
+            generation_start = (time.time(), len(SOLUTIONS), cache_hits(SOLVER))
+
+    return sort_population(POPULATION_X)
+
+
+def cache_hits(SOLVER):
+    if SOLVER["fitness_cache"] is None:
+        return 0
+    return SOLVER["fitness_cache"]["hits"]
+
+
+def generation_summary(generation, POPULATION_X, SOLUTIONS, SOLVER, generation_start):
+    """
+    Record logged as JSON (logger INFO) after every generation. generation_start is the
+    (time, len(SOLUTIONS), cache hits) at the start of the generation:
+        evaluations   genomas fitted in the generation (cache hits excluded).
+        cache_hits    genomas read from the fitness cache in the generation.
+        wall_time     seconds taken by the generation.
+    best_score and mean_score only count the individuals with a finite score that were
+    evaluated (not over max_features); they are null when there is none.
+    """
+    start_time, n_solutions, start_hits = generation_start
+    scores = np.array([POPULATION_X[key]["SCORE"] for key in POPULATION_X.keys()], dtype = float)
+    scores = scores[np.isfinite(scores) & (scores > -1e35)]
+    hits = cache_hits(SOLVER) - start_hits
+    SUMMARY = dict()
+    SUMMARY["generation"]  = int(generation)
+    SUMMARY["best_score"]  = float(np.max(scores)) if len(scores) > 0 else None
+    SUMMARY["mean_score"]  = float(np.mean(scores)) if len(scores) > 0 else None
+    SUMMARY["evaluations"] = len(SOLUTIONS) - n_solutions - hits
+    SUMMARY["cache_hits"]  = hits
+    SUMMARY["solutions"]   = len(SOLUTIONS)
+    SUMMARY["wall_time"]   = time.time() - start_time
+    return SUMMARY
+
+
+def solve_population(POPULATION, SOLUTIONS, SOLVER, race_threshold = None, screen = False):
+    """
+    Scores the individuals of POPULATION that are not SCORED yet, the others (e.g. the
+    children that are copies of their parents) are not even looked at. Genomas are
+    looked up first in SOLUTIONS and in the persistent fitness cache, the rest are sent
+    to the worker pool (SOLVER["pool"]) or scored sequentially when there is no pool. race_threshold is the score an
+    individual must beat to be evaluated on every fold (only used with race_min_folds).
+    With SOLVER["halving"] the new genomas go first through halving_solve. With screen = True
+    and SOLVER["surrogate"] only the genomas kept by surrogate_screen are fitted.
+    """
+    POPULATION_FIT = dict()
+    for individual in POPULATION.keys():
+        if not POPULATION[individual]["SCORED"]:
+            POPULATION_FIT[individual] = POPULATION[individual]
+    if len(POPULATION_FIT) == 0:
+        return POPULATION
+    check_fenotype(POPULATION_FIT)
+
+    if SOLVER["fitness_cache"] is not None:
+        utils_fitness_cache.load_solutions(SOLVER["fitness_cache"], POPULATION_FIT, SOLUTIONS)
+
+    if screen and SOLVER["surrogate"] is not None:
+        POPULATION_FIT = surrogate_screen(POPULATION_FIT, SOLUTIONS, SOLVER["surrogate"])
+
+    if SOLVER["halving"]:
+        halving_solve(POPULATION_FIT, SOLUTIONS, SOLVER)
+
+    if SOLVER["pool"] is not None:
+        parallel_solve(POPULATION_FIT, SOLUTIONS, SOLVER["pool"], race_threshold)
+    else:
+        sequential_solve(POPULATION_FIT, SOLUTIONS, SOLVER["n_workers"], SOLVER["model"],
+                         SOLVER["folds"], SOLVER["df_exmodel"], SOLVER["error_type"],
+                         SOLVER["max_features"], SOLVER["round_prediction"],
+                         SOLVER["fold_workers"], SOLVER["race_min_folds"], race_threshold)
+
+    if SOLVER["fitness_cache"] is not None:
+        utils_fitness_cache.save_solutions(SOLVER["fitness_cache"], POPULATION_FIT, SOLUTIONS)
+    return POPULATION
+
+
+def build_surrogate(surrogate):
+    """
+    Builds the SURROGATE used by surrogate_screen from the surrogate option of
+    solve_genetic_algorithm:
+        keep           fraction of the new genomas fitted, the best predicted ones (default .5).
+        explore        fraction of the genomas left out that is fitted anyway, chosen at
+                       random (default .1).
+        min_solutions  scored genomas needed before the surrogate is used (default 50).
+        model          sklearn regressor fitted on (chromosome, score rank) pairs
+                       (default linear_model.Ridge()).
+    Returns None when surrogate is None.
+    """
+    if surrogate is None:
+        return None
+    SURROGATE = dict()
+    SURROGATE["keep"]          = surrogate.get("keep", .5)
+    SURROGATE["explore"]       = surrogate.get("explore", .1)
+    SURROGATE["min_solutions"] = surrogate.get("min_solutions", 50)
+    SURROGATE["model"]         = surrogate.get("model", linear_model.Ridge())
+    SURROGATE["screened"]      = 0
+    return SURROGATE
+
+
+def surrogate_screen(POPULATION, SOLUTIONS, SURROGATE):
+    """
+    Surrogate-assisted selection of the individuals of POPULATION worth fitting. The
+    surrogate is trained on the chromosomes of the fully scored genomas of SOLUTIONS and
+    predicts the new genomas; the SURROGATE["keep"] best ones plus a random
+    SURROGATE["explore"] fraction of the rest are returned to be fitted. The individuals
+    left out get the worst score, so they are not selected, and are not written to
+    SOLUTIONS: a later generation can still fit them. The surrogate is trained on the
+    rank of the scores, so the scores of the individuals with too many features don't
+    distort it.
+    """
+    scored = [genoma for genoma in SOLUTIONS.keys() if not SOLUTIONS[genoma].get("raced", False)]
+    new = list(dict.fromkeys([POPULATION[individual]["GENOMA"] for individual in POPULATION.keys()
+                              if POPULATION[individual]["GENOMA"] not in SOLUTIONS]))
+    if len(scored) < SURROGATE["min_solutions"] or len(new) <= 1:
+        return POPULATION
+
+    X_scored = np.vstack([np.concatenate([SOLUTIONS[genoma]["baseline_features_chromosome"],
+                                          SOLUTIONS[genoma]["exmodel_features_chromosome"]]) for genoma in scored])
+    scores = np.array([SOLUTIONS[genoma]["score"] for genoma in scored], dtype = float)
+    SURROGATE["model"].fit(X_scored, np.argsort(np.argsort(scores, kind = "stable")))
+
+    chromosomes = dict()
+    for individual in POPULATION.keys():
+        chromosomes[POPULATION[individual]["GENOMA"]] = POPULATION[individual]["CHROMOSOME"]
+    predicted = SURROGATE["model"].predict(np.vstack([chromosomes[genoma] for genoma in new]))
+    order = np.argsort(-predicted, kind = "stable")
+    n_keep = max(1, int(np.ceil(len(new)*SURROGATE["keep"])))
+    rest = order[n_keep:]
+    explore = rest[np.random.uniform(0, 1, len(rest)) < SURROGATE["explore"]]
+    fitted = set([new[position] for position in np.concatenate([order[:n_keep], explore])])
+
+    POPULATION_FIT = dict()
+    for individual in POPULATION.keys():
+        genoma = POPULATION[individual]["GENOMA"]
+        if genoma in SOLUTIONS or genoma in fitted:
+            POPULATION_FIT[individual] = POPULATION[individual]
+        else:
+            POPULATION[individual]["SCORE"] = - 1000000000000000000000000000000000000
+    SURROGATE["screened"] += len(new) - len(fitted)
+    logger.debug("SURROGATE: %s genomas fitted out of %s", len(fitted), len(new))
+    return POPULATION_FIT
+
+
+def halving_solve(POPULATION, SOLUTIONS, SOLVER):
+    """
+    Successive halving over the genomas of POPULATION that are not in SOLUTIONS. Every
+    round of SOLVER["halving"] is a fidelity:
+        folds       number of folds evaluated (default all of them).
+        rows        fraction of the training rows used to fit (default 1).
+        estimators  fraction of n_estimators for models that have it (default 1).
+        promote     fraction of the genomas that goes on to the next round (default .5).
+    The genomas that are not promoted are written to SOLUTIONS with the worst score, so
+    they are never selected nor fitted again in the run, and with their cheap score in
+    "fidelity_score". The promoted ones are left for the full score of solve_population.
+    """
+    PENDING = dict()
+    for individual in POPULATION.keys():
+        genoma = POPULATION[individual]["GENOMA"]
+        if genoma not in SOLUTIONS and genoma not in PENDING:
+            PENDING[genoma] = dict(POPULATION[individual])
+
+    for halving_round, fidelity in enumerate(SOLVER["halving"]):
+        if len(PENDING) <= 1:
+            break
+        FIDELITY_SOLUTIONS = dict()
+        if SOLVER["pool"] is not None:
+            parallel_solve(PENDING, FIDELITY_SOLUTIONS, SOLVER["pool"], fidelity = fidelity)
+        else:
+            sequential_solve(PENDING, FIDELITY_SOLUTIONS, SOLVER["n_workers"], SOLVER["model"],
+                             SOLVER["folds"], SOLVER["df_exmodel"], SOLVER["error_type"],
+                             SOLVER["max_features"], SOLVER["round_prediction"],
+                             SOLVER["fold_workers"], fidelity = fidelity)
+
+        genomas = [genoma for genoma in PENDING.keys() if genoma in FIDELITY_SOLUTIONS]
+        scores = np.array([FIDELITY_SOLUTIONS[genoma]["score"] for genoma in genomas], dtype = float)
+        order = np.argsort(-scores, kind = "stable")
+        n_promoted = max(1, int(np.ceil(len(genomas)*fidelity.get("promote", .5))))
+        for position in order[n_promoted:]:
+            genoma = genomas[position]
+            genoma_solutions = FIDELITY_SOLUTIONS[genoma]
+            genoma_solutions["fidelity_score"] = genoma_solutions["score"]
+            genoma_solutions["score"]  = - 1000000000000000000000000000000000000
+            genoma_solutions["halving_round"] = halving_round
+            genoma_solutions["raced"]  = True
+            SOLUTIONS[genoma] = genoma_solutions
+            del PENDING[genoma]
+        logger.debug("HALVING round %s: %s genomas promoted out of %s", halving_round, len(PENDING), len(genomas))
 
 
 def save_obj(obj, name ):
@@ -169,8 +718,9 @@ def test_baseline_xy(POPULATION_X, POPULATION_Y):
         if baseline_features_x == baseline_features_y:
            equal_individuals += 1 
     if equal_individuals == len(POPULATION_X.keys()):
-        print("\t WARNING: baseline_features are the same in POPULATION_X and POPULATION_Y")
-    print("\t BASELINE: equal_individuals in POPULATION_X and POPULATION_Y: {} out of X{}, Y{} ".format( equal_individuals, len(POPULATION_Y), len(POPULATION_X)))
+        logger.warning("baseline_features are the same in POPULATION_X and POPULATION_Y")
+    logger.debug("BASELINE: equal_individuals in POPULATION_X and POPULATION_Y: %s out of X%s, Y%s",
+                 equal_individuals, len(POPULATION_Y), len(POPULATION_X))
 
 
 def test_chromosome_xy(POPULATION_X, POPULATION_Y):
@@ -178,217 +728,407 @@ def test_chromosome_xy(POPULATION_X, POPULATION_Y):
     for key in POPULATION_Y.keys():
         baseline_features_y =  POPULATION_Y[key]["baseline_features_chromosome"]
         baseline_features_x =  POPULATION_X[key]["baseline_features_chromosome"]
-        if baseline_features_x == baseline_features_y:
+        if np.array_equal(baseline_features_x, baseline_features_y):
            equal_individuals += 1 
     if equal_individuals == len(POPULATION_X.keys()):
-        print("\t WARNING: baseline_features are the same in POPULATION_X and POPULATION_Y")
-    print("\t CHROMOSOME: equal_individuals in POPULATION_X and POPULATION_Y: {} out of X{}, Y{} ".format( equal_individuals, len(POPULATION_Y), len(POPULATION_X)))
+        logger.warning("baseline_features are the same in POPULATION_X and POPULATION_Y")
+    logger.debug("CHROMOSOME: equal_individuals in POPULATION_X and POPULATION_Y: %s out of X%s, Y%s",
+                 equal_individuals, len(POPULATION_Y), len(POPULATION_X))
 
 
 
-def parallel_solve(POPULATION_X, SOLUTIONS, LOCK, N_WORKERS, MODEL, df_kfolded, df_exmodel, error_type, max_features, round_prediction):
+def limit_cores(model_class, cores):
     """
-    Each individual in POPULATION_X is assigned to a different process to score it's own
-    genoma. Each genoma is scored based on the scoring function and parameters saved individual_score
-    MODEL dictionary.
+    Makes the model wrapper (see intramodel_hyperparameters_regressor) use cores threads:
+    sets its cores_number and the n_jobs/nthread param of the estimator inside it.
     """
-    parallel_execution = True
-    s = 0
-    POPULATION_SIZE = len(POPULATION_X)
-    while s < POPULATION_SIZE-1: 
-        #EN esta parte antes de meterlo a procesamiento deberia buscar la solucion...
-        started_process = list()
-        active_workers = 0
-
-        while active_workers < N_WORKERS:
-            if s >= POPULATION_SIZE:
-                break
-            else:
-                if POPULATION_X[s]["GENOMA"] in SOLUTIONS.keys():
-                    if MODEL["model_name"] in ["LR"]:
-                        #print("Modelo encontrado en ", MODEL["model_name"])
-                        continue
-                    s+=1
-                else:
-                    #<------SOLVE
-                    #TO DO: tenemos Z started_processes, estos deberian repartire los cores
-                    started_process.append(s)
-                    s+=1
-                    active_workers +=1
-        model_name = MODEL["model_name"]
-        for s in started_process:
-            CORES_PER_SESION = MODEL["params"]["n_workers"]
-            time.sleep( random.randint(0,len(started_process)) * .05)
-            POPULATION_X[s]["PROCESS"] = multiprocessing.Process( target= MODEL["function"] , 
-                                        args=(POPULATION_X[s], model_name, SOLUTIONS, 
-                                        CORES_PER_SESION, LOCK, MODEL, df_kfolded, df_exmodel, error_type,
-                                        max_features, round_prediction, parallel_execution, ))
+    model_class.cores_number = cores
+    estimator = getattr(model_class, "model", None)
+    if hasattr(estimator, "get_params") and not isinstance(estimator, type):
+        params = estimator.get_params()
+        estimator.set_params(**dict([(param, cores) for param in ["n_jobs", "nthread"] if param in params]))
+    return model_class
 
-            POPULATION_X[s]["PROCESS"].start()
 
-        #print("STARTED PROCESSES: \n\t", started_process)
-
-        for sp in started_process:  # <---CUANTOS CORES TENGO 
-            POPULATION_X[sp]["PROCESS"].join()
-            del POPULATION_X[sp]["PROCESS"]
+def start_worker_pool(N_WORKERS, MODEL, FOLD_STORE, df_exmodel, error_type,
+                      max_features, round_prediction, fold_workers = 1, race_min_folds = None):
+    """
+    Starts N_WORKERS long-lived processes that stay alive for the whole solve_genetic_algorithm
+    run. Every worker attaches once, at start-up, to the shared FOLD_STORE built with
+    utils_fold_store.build_fold_store, so the folds are never copied into the workers.
+    Afterwards the workers only receive individuals through POOL["tasks"] and send
+    every (genoma, genoma_solutions) back through POOL["results"], so a free worker picks
+    up the next individual without waiting for the slowest fit of the batch. The parent
+    is the only process that writes SOLUTIONS. With MODEL["batch_function"] (see
+    utils_linear_scoring.score_linear_population) every task is a chunk of individuals.
+    The workers fit with a single thread each (see limit_cores), so the pool never uses
+    more than N_WORKERS cores.
+    """
+    MODEL = dict(MODEL)
+    MODEL["model_class"] = limit_cores(copy.deepcopy(MODEL["model_class"]), 1)
+    POOL = dict()
+    POOL["batch"]   = "batch_function" in MODEL
+    POOL["tasks"]   = multiprocessing.Queue()
+    POOL["results"] = multiprocessing.Queue()
+    POOL["workers"] = list()
+    for w in range(N_WORKERS):
+        worker = multiprocessing.Process( target= worker_loop,
+                                          args=(POOL["tasks"], POOL["results"], MODEL,
+                                          FOLD_STORE, df_exmodel, error_type, max_features,
+                                          round_prediction, fold_workers, race_min_folds, ))
+        worker.daemon = True
+        worker.start()
+        POOL["workers"].append(worker)
+    return POOL
+
+
+def worker_loop(TASKS, RESULTS, MODEL, FOLD_STORE, df_exmodel, error_type,
+                max_features, round_prediction, fold_workers, race_min_folds):
+    """
+    Body of every process in the worker pool. Pulls (INDIVIDUALS, race_threshold, fidelity)
+    tasks until it receives None, scores them with MODEL["batch_function"] when there is one
+    or with MODEL["function"] one by one, and sends back (genoma, genoma_solutions) for every
+    individual. genoma_solutions is None when the scoring function failed.
+    """
+    model_name = MODEL["model_name"]
+    CORES_PER_SESION = MODEL["params"]["n_workers"]
+    FOLDS = utils_fold_store.attach_fold_store(FOLD_STORE)
+    while True:
+        task = TASKS.get()
+        if task is None:
+            break
+        INDIVIDUALS, race_threshold, fidelity = task
+        if "batch_function" in MODEL:
+            try:
+                batch_solutions = MODEL["batch_function"](INDIVIDUALS, model_name, CORES_PER_SESION, MODEL,
+                                                          FOLDS, df_exmodel, error_type, max_features,
+                                                          round_prediction, fold_workers, race_threshold,
+                                                          race_min_folds, fidelity)
+            except Exception:
+                traceback.print_exc()
+                batch_solutions = [None]*len(INDIVIDUALS)
+            for INDIVIDUAL, genoma_solutions in zip(INDIVIDUALS, batch_solutions):
+                RESULTS.put((INDIVIDUAL["GENOMA"], genoma_solutions))
+            continue
+        for INDIVIDUAL in INDIVIDUALS:
+            genoma_solutions = None
+            try:
+                genoma_solutions = MODEL["function"](INDIVIDUAL, model_name, CORES_PER_SESION, MODEL,
+                                                     FOLDS, df_exmodel, error_type, max_features,
+                                                     round_prediction, fold_workers, race_threshold,
+                                                     race_min_folds, fidelity)
+            except Exception:
+                traceback.print_exc()
+            RESULTS.put((INDIVIDUAL["GENOMA"], genoma_solutions))
+    utils_fold_store.detach_fold_store(FOLDS)
+
+
+def stop_worker_pool(POOL):
+    """
+    Sends one stop signal per worker and waits for all of them to finish. When the run
+    is interrupted in the middle of a generation the tasks still queued are dropped and
+    the results still arriving are discarded, so no worker blocks on a full queue.
+    """
+    try:
+        while True:
+            POOL["tasks"].get_nowait()
+    except queue.Empty:
+        pass
+    for worker in POOL["workers"]:
+        POOL["tasks"].put(None)
+    for worker in POOL["workers"]:
+        while worker.is_alive():
+            worker.join(timeout = .1)
+            try:
+                while True:
+                    POOL["results"].get_nowait()
+            except queue.Empty:
+                pass
+
+
+def parallel_solve(POPULATION_X, SOLUTIONS, POOL, race_threshold = None, fidelity = None):
+    """
+    Every individual in POPULATION_X whose genoma is not in SOLUTIONS is queued in the
+    worker pool. Workers pull individuals as soon as they are free and stream back the
+    results, which are written to SOLUTIONS here; the function returns once the whole
+    population is scored. With a batch model (POOL["batch"]) the new genomas are split in
+    one chunk per worker.
+    IN_FLIGHT keeps, for every genoma dispatched, the individuals that share it; each
+    genoma is sent once and all of them get the same result.
+    """
+    POPULATION_SIZE = len(POPULATION_X)
+    IN_FLIGHT = dict()
+    for s in POPULATION_X.keys():
+        if POPULATION_X[s]["GENOMA"] not in SOLUTIONS:
+            IN_FLIGHT.setdefault(POPULATION_X[s]["GENOMA"], list()).append(POPULATION_X[s])
+    INDIVIDUALS = [waiting[0] for waiting in IN_FLIGHT.values()]
+    if POOL["batch"]:
+        chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(INDIVIDUALS)), len(POOL["workers"]))]
+    else:
+        chunks = [[i] for i in range(len(INDIVIDUALS))]
+    for chunk in chunks:
+        if len(chunk) > 0:
+            POOL["tasks"].put(([INDIVIDUALS[i] for i in chunk], race_threshold, fidelity))
+
+    while len(IN_FLIGHT) > 0:
+        try:
+            genoma, genoma_solutions = POOL["results"].get(timeout = 5)
+            if IN_FLIGHT.pop(genoma, None) is None:
+                continue
+            if genoma_solutions is not None:
+                SOLUTIONS[genoma] = genoma_solutions
+        except queue.Empty:
+            if not all([worker.is_alive() for worker in POOL["workers"]]):
+                raise RuntimeError("A worker of the pool died while scoring the population")
 
-    #save_obj(SOLUTIONS, "ga_solutions")
     #All genoma in SOLUTIONS
     for s in POPULATION_X.keys():
-        if  POPULATION_X[s]["GENOMA"] in SOLUTIONS.keys():
+        if  POPULATION_X[s]["GENOMA"] in SOLUTIONS:
             POPULATION_X[s]["SCORE"] = SOLUTIONS[POPULATION_X[s]["GENOMA"]]["score"]
             POPULATION_X[s]["PROB"] = POPULATION_X[s]["SCORE"] / POPULATION_SIZE
+            POPULATION_X[s]["SCORED"] = True
         else:
-                print("**WARNING: GENOMA not found in SOLUTIONS after scoring")
+                logger.warning("GENOMA not found in SOLUTIONS after scoring")
 
     return POPULATION_X
 
 
-def sequential_solve(POPULATION_X, SOLUTIONS, N_WORKERS, MODEL, df_kfolded, df_exmodel, 
-                    error_type, max_features, round_prediction):
+def sequential_solve(POPULATION_X, SOLUTIONS, N_WORKERS, MODEL, FOLDS, df_exmodel, 
+                    error_type, max_features, round_prediction, fold_workers = 1,
+                    race_min_folds = None, race_threshold = None, fidelity = None):
     """
     Each individual in POPULATION_X is assigned to a different process to score it's own
     genoma. Each genoma is scored based on the scoring function and parameters saved individual_score
-    MODEL dictionary.
+    MODEL dictionary. With MODEL["batch_function"] the new genomas are scored in a single call.
     """
     s = 0
     model_name = MODEL["model_name"]
     POPULATION_SIZE = len(POPULATION_X)
+    if "batch_function" in MODEL:
+        NEW = dict()
+        for s in POPULATION_X.keys():
+            if POPULATION_X[s]["GENOMA"] not in SOLUTIONS:
+                NEW[POPULATION_X[s]["GENOMA"]] = POPULATION_X[s]
+        if len(NEW) > 0:
+            batch_solutions = MODEL["batch_function"](list(NEW.values()), model_name, MODEL["params"]["n_workers"],
+                                                      MODEL, FOLDS, df_exmodel, error_type, max_features,
+                                                      round_prediction, fold_workers, race_threshold,
+                                                      race_min_folds, fidelity)
+            for genoma, genoma_solutions in zip(NEW.keys(), batch_solutions):
+                SOLUTIONS[genoma] = genoma_solutions
     for s in POPULATION_X.keys():
-        if POPULATION_X[s]["GENOMA"] in SOLUTIONS.keys():
+        if POPULATION_X[s]["GENOMA"] in SOLUTIONS:
             #print("Modelo encontrado en model_namel: ", MODEL["model_name"])
             continue
         else:
             CORES_PER_SESION = MODEL["params"]["n_workers"]
-            score_model(POPULATION_X[s], model_name, SOLUTIONS, 
-                    CORES_PER_SESION, None, MODEL, df_kfolded, df_exmodel, 
-                    error_type, max_features, round_prediction, parallel_execution = False)
+            SOLUTIONS[POPULATION_X[s]["GENOMA"]] = score_model(POPULATION_X[s], model_name,
+                    CORES_PER_SESION, MODEL, FOLDS, df_exmodel, 
+                    error_type, max_features, round_prediction, fold_workers,
+                    race_threshold, race_min_folds, fidelity)
 
     for s in POPULATION_X.keys():
-        if  POPULATION_X[s]["GENOMA"] in SOLUTIONS.keys():
+        if  POPULATION_X[s]["GENOMA"] in SOLUTIONS:
             POPULATION_X[s]["SCORE"] = SOLUTIONS[POPULATION_X[s]["GENOMA"]]["score"]
             POPULATION_X[s]["PROB"] = POPULATION_X[s]["SCORE"] / POPULATION_SIZE
+            POPULATION_X[s]["SCORED"] = True
         else:
-            print("**WARNING: GENOMA not found in SOLUTIONS after scoring")
+            logger.warning("GENOMA not found in SOLUTIONS after scoring")
 
     return POPULATION_X
 
 
-def score_model(INDIVIDUAL, model_name, SOLUTIONS, CORES_PER_SESION, LOCK, MODEL, df_kfolded, df_exmodel, error_type, max_features, round_prediction = False, parallel_execution = True):
+def score_model(INDIVIDUAL, model_name, CORES_PER_SESION, MODEL, FOLDS, df_exmodel, error_type, max_features,
+                round_prediction = False, fold_workers = 1, race_threshold = None, race_min_folds = None,
+                fidelity = None):
     """
     Scores the model inside a neuron given a particular set of variables and calculates
-    the ERROR_TYPES[error_type] for each fold in df_kfolded.
+    the ERROR_TYPES[error_type] for each fold in FOLDS (see utils_fold_store.attach_fold_store).
+    The train and test sets of every fold are taken from FOLDS["X"] with the rows of
+    FOLDS["plan"] and the columns of the individual.
+        fold_workers > 1: the folds are fitted concurrently in fold_workers threads, each
+                          one with its own copy of MODEL["model_class"].
+        race_threshold:   once race_min_folds folds are evaluated, the individual is
+                          abandoned as soon as its partial score is below race_threshold.
+                          Its score is then the partial one and "folds_evaluated" tells
+                          how many folds it took.
+        fidelity:         cheap evaluation used by halving_solve, only the first
+                          fidelity["folds"] folds with a fidelity["rows"] fraction of the
+                          training rows and a fidelity["estimators"] fraction of n_estimators.
+    Returns genoma_solutions, the entry of SOLUTIONS for the genoma of INDIVIDUAL. The
+    fitted model is not included, the genetic algorithm only needs the score and the
+    chromosome.
     """
-    genoma =  INDIVIDUAL["GENOMA"]
     baseline_features = INDIVIDUAL["baseline_features"]
     exmodel_features  = INDIVIDUAL["exmodel_features"]
-    baseline_features_chromosome = INDIVIDUAL["baseline_features_chromosome"]
-    exmodel_features_chromosome  = INDIVIDUAL["exmodel_features_chromosome"]
     if df_exmodel:
         total_features = len(baseline_features) + len(exmodel_features) 
     else: 
         total_features = len(baseline_features)
     #print("\n\nTEST SKLEARN_MODELS: {} \n ERROR_TYPES: {} ".format(SKLEARN_MODELS, ERROR_TYPES))
-    model = copy.deepcopy(MODEL["model_class"]) #XGBOOST(XGBRegressor, 1)
-    total_error = 0
+    fidelity = fidelity or dict()
+    folds = FOLDS["folds"][:fidelity.get("folds", len(FOLDS["folds"]))]
+    train_fraction = fidelity.get("rows", 1)
+    model_class = MODEL["model_class"]
+    if fidelity.get("estimators", 1) < 1:
+        model_class = reduce_estimators(copy.deepcopy(model_class), fidelity["estimators"])
+
+    errors = list()
     if total_features > max_features: #or total_features == 0:
-        print("WARNING: model not evelauted, number of features bigger than max_features or equal to zero: ", total_features)
-        total_error = 1000000000000000000000000000000000000
+        logger.warning("model not evaluated, number of features bigger than max_features: %s", total_features)
+        errors = [1000000000000000000000000000000000000]*len(folds)
     else:
+        columns = feature_columns(FOLDS, INDIVIDUAL, df_exmodel)
+
+        if fold_workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = fold_workers)
+            futures = [executor.submit(fold_error, copy.deepcopy(model_class), FOLDS, test_fold,
+                                       columns, train_fraction) for test_fold in folds]
+            for future in concurrent.futures.as_completed(futures):
+                errors.append(future.result())
+                if lost_race(errors, len(folds), total_features, race_threshold, race_min_folds):
+                    break
+            executor.shutdown(wait = True, cancel_futures = True)
+        else:
+            model = copy.deepcopy(model_class) #XGBOOST(XGBRegressor, 1)
+            for test_fold in folds:
+                errors.append(fold_error(model, FOLDS, test_fold, columns, train_fraction))
+                if lost_race(errors, len(folds), total_features, race_threshold, race_min_folds):
+                    break
+
+    score =  - (np.sum(errors)/len(errors)) - total_features*.00001
+    #print("\n\n RESULTS: \n\ttotal_error: {} \
+    #\n\tlength_error: {}  \n\ttotal_features: {}\
+    #\n\tlen baseline_features: {} \n\tbaseline_features: {}\
+    #\n\t score{} ".format(- (np.sum(errors)/len(errors)), - total_features*.00001,\
+    #total_features, len(baseline_features),baseline_features, score))
+    genoma_solutions = solution_record(INDIVIDUAL, score)
+    genoma_solutions["folds_evaluated"] = len(errors)
+    genoma_solutions["raced"] = len(errors) < len(FOLDS["folds"])
+    return genoma_solutions
+
+
+def feature_columns(FOLDS, INDIVIDUAL, df_exmodel = None):
+    """
+    Positions in FOLDS["X"] of the baseline features of INDIVIDUAL followed by its exmodel
+    features, which are only used when there is a df_exmodel.
+    """
+    features = INDIVIDUAL["baseline_features"]
+    if df_exmodel:
+        features = features + INDIVIDUAL["exmodel_features"]
+    return [FOLDS["column_position"][feature] for feature in features]
 
-        for test_fold in df_kfolded.keys():
-            #print("test_fold: ", test_fold)
-            if test_fold == "all_data":
-                continue
-            else:
-                X_test_baseline  = df_kfolded[test_fold]["data"].copy()
-                X_test_baseline  = X_test_baseline[baseline_features]
-                if df_exmodel:
-                    X_test_exmodel = df_exmodel[test_fold]
-                    X_test_exmodel = X_test_exmodel[exmodel_features]
-                    X_test = X_test_baseline.merge(X_test_exmodel, right_index = True, left_index =  True)
-                else:
-                    X_test = X_test_baseline
-
-                y_test  = df_kfolded[test_fold]["y"].copy()
-
-                X_train_baseline = pd.DataFrame()
-                y_train = pd.DataFrame()
-
-                for train_fold in df_kfolded.keys():
-                    #print("train_fold: ", train_fold)
-                    if train_fold == "all_data" or train_fold == test_fold:
-                        continue 
-                    else:
-                        if len(X_train_baseline)==0:
-                            X_train_baseline = df_kfolded[train_fold]["data"]
-                            X_train_baseline = X_train_baseline[baseline_features]
-                            if df_exmodel:
-                                X_train_exmodel  = df_exmodel[train_fold]
-                                X_train_exmodel  = X_train_exmodel[exmodel_features]
-                                X_train = X_train_baseline.merge(X_train_exmodel, right_index = True, left_index = True)
-                            else:
-                                X_train = X_train_baseline
-
-                            y_train = df_kfolded[train_fold]["y"].copy()
-
-                        else:
-                            X_train_baseline_append = df_kfolded[train_fold]["data"]
-                            X_train_baseline_append = X_train_baseline_append[baseline_features]
-                            if df_exmodel:
-                                X_train_exmodel_append = df_exmodel[train_fold]
-                                X_train_exmodel_append = X_train_exmodel_append[exmodel_features]
-                                X_train_append = X_train_baseline_append.merge(X_train_exmodel_append, right_index = True, left_index=True)
-                            else:
-                                X_train_append = X_train_baseline_append
-
-                            X_train = X_train.append(X_train_append)
-                            y_train = y_train.append(df_kfolded[train_fold]["y"].copy()) 
-                #test_wrongfold_assignation(X_train, X_test)
-                model.fit(X_train, y_train, X_test, y_test)
-                #time.sleep(.001)
-                prediction   = model.predict(X_test)
-                prediction[prediction < 0] = 0
-
-                #print("\n\nPRUEBA prediction: {} \n y_test {}, \n difference: {}".format( prediction[:10], y_test.mean(), np.mean(prediction - y_test)))
-                #if round_prediction:
-                #    prediction = np.round(prediction)
-                error = error_function(y_test, prediction)
-                total_error += error
-
-
-        genoma = baseline_features_chromosome +  exmodel_features_chromosome
-        score =  - (total_error/(len(df_kfolded.keys())-1)) - total_features*.00001
-        genoma_solutions = dict()
-        genoma_solutions["score"] = score
-        genoma_solutions["genoma"] = genoma
-        genoma_solutions["baseline_features"] = baseline_features
-        genoma_solutions["exmodel_features"] = exmodel_features
-        genoma_solutions["model"] = model
-        genoma_solutions["exmodel_features_chromosome"] =exmodel_features_chromosome
-        genoma_solutions["baseline_features_chromosome"] = baseline_features_chromosome
-
-    if parallel_execution:
-        #print("\n\n RESULTS: \n\ttotal_error: {} \
-        #\n\tlength_error: {}  \n\ttotal_features: {}\
-        #\n\tlen baseline_features: {} \n\tbaseline_features: {}\
-        #\n\t score{} ".format(- (total_error/(len(df_kfolded.keys())-1)), - total_features*.00001,\
-        #total_features, len(baseline_features),baseline_features, score))
-        time.sleep( random.randint(0,16) * .05)
-        LOCK.acquire()
-        SOLUTIONS[genoma] = genoma_solutions
-        LOCK.release()
 
-    else:
-        #print("\n\n RESULTS: \n\ttotal_error: {} \
-        #\n\tlength_error: {}  \n\ttotal_features: {}\
-        #\n\tlen baseline_features: {} \n\tbaseline_features: {}\
-        #\n\t score{} ".format(- (total_error/(len(df_kfolded.keys())-1)), - total_features*.00001,\
-        #total_features, len(baseline_features),baseline_features, score))
+def fold_error(model, FOLDS, test_fold, columns, train_fraction = 1):
+    """
+    Fits model on the training rows of test_fold and returns the error on test_fold.
+    With train_fraction < 1 the model is fitted on a subsample of the training rows.
+    """
+    train_rows = subsample_rows(FOLDS["plan"][test_fold]["train"], train_fraction)
+    prediction = fold_prediction(model, FOLDS, test_fold, columns, train_rows)
+
+    #print("\n\nPRUEBA prediction: {} \n y_test {}, \n difference: {}".format( prediction[:10], y_test.mean(), np.mean(prediction - y_test)))
+    #if round_prediction:
+    #    prediction = np.round(prediction)
+    return error_function(FOLDS["y"][FOLDS["plan"][test_fold]["test"]], prediction)
+
+
+def fold_prediction(model, FOLDS, test_fold, columns, train_rows = None):
+    """
+    Fits model on train_rows (the training rows of the plan by default) and returns its
+    prediction for the rows of test_fold, in the row order of the fold. The matrices come
+    from the column-block cache (see utils_fold_store.fold_matrix).
+    """
+    if train_rows is None:
+        train_rows = FOLDS["plan"][test_fold]["train"]
+    test_rows  = FOLDS["plan"][test_fold]["test"]
+
+    X_train, X_test, features = utils_fold_store.fold_matrix(FOLDS, test_fold, columns, train_rows)
+    X_train = pd.DataFrame(X_train, columns = features, copy = False)
+    X_test  = pd.DataFrame(X_test, columns = features, copy = False)
+    y_train = FOLDS["y"][train_rows]
+    y_test  = FOLDS["y"][test_rows]
+
+    #test_wrongfold_assignation(X_train, X_test)
+    model.fit(X_train, y_train, X_test, y_test)
+    prediction   = np.asarray(model.predict(X_test), dtype = np.float64)
+    prediction[prediction < 0] = 0
+    return prediction
 
-        SOLUTIONS[genoma]= genoma_solutions
+
+def out_of_fold_predictions(INDIVIDUAL, MODEL, df_kfolded, df_exmodel = None):
+    """
+    Fits MODEL with the features of INDIVIDUAL once per fold of df_kfolded, on the rows of
+    the other folds, and returns PREDICTIONS[fold], the prediction for the rows of fold in
+    the order of df_kfolded[fold]["index"]. No row is predicted by a model that saw it, so
+    the predictions can be used as features by the neurons of upper layers.
+    """
+    FOLD_STORE = utils_fold_store.build_fold_store(df_kfolded, shared = False, df_exmodel = df_exmodel)
+    FOLDS = utils_fold_store.attach_fold_store(FOLD_STORE)
+    try:
+        columns = feature_columns(FOLDS, INDIVIDUAL, df_exmodel)
+        model = copy.deepcopy(MODEL["model_class"])
+        PREDICTIONS = dict()
+        for test_fold in FOLDS["folds"]:
+            PREDICTIONS[test_fold] = fold_prediction(model, FOLDS, test_fold, columns)
+    finally:
+        utils_fold_store.detach_fold_store(FOLDS)
+        utils_fold_store.release_fold_store(FOLD_STORE)
+    return PREDICTIONS
+
+
+def subsample_rows(rows, fraction):
+    """
+    Returns a fraction of rows, sorted. The sample only depends on len(rows), so every
+    individual is fitted on the same rows of a fold.
+    """
+    if fraction >= 1:
+        return rows
+    n_rows = max(1, int(len(rows)*fraction))
+    sample = np.random.RandomState(len(rows)).choice(len(rows), n_rows, replace = False)
+    return rows[np.sort(sample)]
 
 
+def reduce_estimators(model, fraction):
+    """
+    Scales by fraction the n_estimators of model, either an attribute of the wrapper (see
+    intramodel_hyperparameters_regressor) or a param of the estimator inside it. Models
+    without n_estimators are returned unchanged.
+    """
+    estimator = getattr(model, "model", None)
+    if hasattr(model, "n_estimators"):
+        model.n_estimators = max(1, int(model.n_estimators*fraction))
+    elif hasattr(estimator, "get_params") and not isinstance(estimator, type) \
+            and "n_estimators" in estimator.get_params():
+        estimator.set_params(n_estimators = max(1, int(estimator.get_params()["n_estimators"]*fraction)))
+    return model
+
+
+def lost_race(errors, n_folds, total_features, race_threshold, race_min_folds):
+    """
+    True when the partial score of the folds evaluated so far is already worse than
+    race_threshold and there are folds left to evaluate.
+    """
+    if race_threshold is None or race_min_folds is None:
+        return False
+    if len(errors) < race_min_folds or len(errors) >= n_folds:
+        return False
+    partial_score = - np.mean(errors) - total_features*.00001
+    return partial_score < race_threshold
+
+
+def solution_record(INDIVIDUAL, score):
+    """
+    Builds the SOLUTIONS entry of a scored INDIVIDUAL.
+    """
+    genoma_solutions = dict()
+    genoma_solutions["score"] = score
+    genoma_solutions["genoma"] = INDIVIDUAL["GENOMA"]
+    genoma_solutions["baseline_features"] = INDIVIDUAL["baseline_features"]
+    genoma_solutions["exmodel_features"] = INDIVIDUAL["exmodel_features"]
+    genoma_solutions["exmodel_features_chromosome"] = INDIVIDUAL["exmodel_features_chromosome"]
+    genoma_solutions["baseline_features_chromosome"] = INDIVIDUAL["baseline_features_chromosome"]
+    return genoma_solutions
 
 
 def test_wrongfold_df_kfolded(df_kfolded):
@@ -504,15 +1244,18 @@ def get_exmodel_features(NEURONAL_SOLUTIONS, eval_layer):
 
 
 def sort_population(POPULATION_X):
-    POPULATION_X_copy = copy.deepcopy(POPULATION_X)
-    POPULATION_sorted = sorted(POPULATION_X_copy.items(), key=lambda x: x[1]["SCORE"], reverse = True)
+    """
+    Returns a new dictionary with the individuals of POPULATION_X ordered by SCORE, best
+    first. Individuals are kept by reference, nothing is copied.
+    """
+    individuals = list(POPULATION_X.values())
+    scores = np.array([individual["SCORE"] for individual in individuals], dtype = float)
+    order = np.argsort(-scores, kind = "stable")
     POPULATION_NEW = dict()
-    result = list()
-    cont = 0
-    for i in POPULATION_sorted:
-        POPULATION_NEW[cont] = i[1]
-        cont += 1
-    test_baseline_xy(POPULATION_X, POPULATION_NEW)
+    for cont, position in enumerate(order):
+        POPULATION_NEW[cont] = individuals[position]
+    if logger.isEnabledFor(logging.DEBUG):
+        test_baseline_xy(POPULATION_X, POPULATION_NEW)
     return POPULATION_NEW
 
 def population_summary(POPULATION_X):
@@ -536,103 +1279,82 @@ def population_summary(POPULATION_X):
             min_score = individual_score
     promedio = suma/len(POPULATION_X_copy.keys())
     equal_individuals = len(lista_genomas) - len(set(lista_genomas))
-    print("\n\nTEST population_summary: \
-        \n\tTOTAL SCORE: {} \n\tMEAN SCORE: {} \
-        \n\t MAX_SCORE: {} \n\tMIN_SCORE: {} \
-        \n\t BASELINE FEAT: {} \n\t EXMODEL FEAT: {}".format(suma, promedio, max_score,\
-         min_score, best_baseline_features, best_exmodel_features))
+    logger.debug("population_summary: TOTAL SCORE: %s MEAN SCORE: %s MAX_SCORE: %s MIN_SCORE: %s "
+                 "BASELINE FEAT: %s EXMODEL FEAT: %s", suma, promedio, max_score, min_score,
+                 best_baseline_features, best_exmodel_features)
 
     return equal_individuals, max_score
 
 
 def select_topn( POPULATION_X, POPULATION_Y, N):
-    POPULATION_Y_copy =  copy.deepcopy(POPULATION_Y)
-    POPULATION_X_copy = copy.deepcopy(POPULATION_X)
-    for key in POPULATION_X_copy.keys():
-        new_key = key  + N
-        POPULATION_Y_copy[new_key] = POPULATION_X_copy[key]
-
-    POPULATION_Y_copy = sort_population(POPULATION_Y_copy)
+    """
+    Keeps the N best individuals of POPULATION_Y + POPULATION_X (offspring first on ties).
+    Only the scores are sorted, the selected individuals are kept by reference.
+    """
+    individuals = list(POPULATION_Y.values()) + list(POPULATION_X.values())
+    scores = np.array([individual["SCORE"] for individual in individuals], dtype = float)
+    order = np.argsort(-scores, kind = "stable")[:N]
     POPULATION_NEW =dict()
-
-    for key in range(N):
-        POPULATION_NEW[key] = POPULATION_Y_copy[key]
+    for key, position in enumerate(order):
+        POPULATION_NEW[key] = individuals[position]
 
     return POPULATION_NEW
 
 
-def cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list, n_col, N, PC, PM):
-    POPULATION_Y = copy.deepcopy(POPULATION_X)
-    #pprint(POPULATION_X)
-    for j in range(int(N/2)):
-        pc = random.uniform(1,0)
-        GENLONG =  len(POPULATION_X[0]["GENOMA"])
-        #CROSSOVER
-        if pc < PC:
-            best = POPULATION_Y[j]["GENOMA"]
-            worst = POPULATION_Y[N -j-1]["GENOMA"]
-            startBest =  best
-            startWorst = worst
-
-            genoma_crossover = random.randint(0, GENLONG)
-            genoma_crossover_final = int(genoma_crossover + np.round(GENLONG/2))
-            if genoma_crossover_final > GENLONG:
-                # To perform a roulette  cross over we need to fill the
-                extra_genes = genoma_crossover_final - GENLONG 
-                genoma_crossover_final =  GENLONG
-
-            else: 
-                extra_genes = 0
-
-            best_partA  = best[:extra_genes]
-            worst_partA = worst[:extra_genes]
-
-            best_partB  = best[extra_genes:genoma_crossover]
-            worst_partB = worst[extra_genes:genoma_crossover]
-
-            best_partC  = best[genoma_crossover:genoma_crossover_final]
-            worst_partC = worst[genoma_crossover: genoma_crossover_final]
-
-            best_partD  = best[genoma_crossover_final:GENLONG]
-            worst_partD = worst[genoma_crossover_final: GENLONG]
-
-            #print("TEST CROSSOVER:   {} -> {} -> {} -> {} \npart A {} \npartB {} \npart C{} \npartD {}".format(extra_genes, genoma_crossover, genoma_crossover_final, GENLONG, best_partA, best_partB, best_partC, best_partD) ) 
-            new_best    = worst_partA + best_partB + worst_partC + best_partD
-            new_worst   = best_partA + worst_partB + best_partC + worst_partD
-
-            endBest = new_best
-            endWorst =  new_worst
-
-            POPULATION_Y[j]["GENOMA"]     = new_best
-            POPULATION_Y[N-j-1]["GENOMA"] = new_worst
-
-            #print("\n\nCrossover Performed on individual {}-{}: \n\t StartBest: {} \n\t NewBest: {} \n\t StartWorst: {} \n\t NewWorst: {}".format(j,genoma_crossover, startBest, endBest, startWorst, endWorst))
-
-    for j in range(N):
-        #MUTATION
-
-        pm = random.uniform(1,0)
-        mutation_gen = random.randint(0, GENLONG-1)
-        mutated_genoma = POPULATION_Y[j]["GENOMA"]
-
-        if pm < PM:
-            #PERFORM MUTATION
-
-            start = mutated_genoma
-            if mutated_genoma[mutation_gen] =="1":
-                mutated_genoma = list(mutated_genoma)
-                mutated_genoma[mutation_gen] = "0"
-                mutated_genoma = "".join(mutated_genoma)
-            else:
-                mutated_genoma = list(mutated_genoma)
-                mutated_genoma[mutation_gen] = "1"
-                mutated_genoma = "".join(mutated_genoma)
-
-            end = mutated_genoma
-
-        POPULATION_Y[j]["GENOMA"] = mutated_genoma
-        POPULATION_Y[j]["baseline_features_chromosome"] = mutated_genoma[:len(columns_list)]
-        POPULATION_Y[j]["exmodel_features_chromosome"]  = mutated_genoma[len(columns_list):]
+def cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list, n_col, N, PC, PM, GENE_MASK = None):
+    """
+    Crossover and mutation of the whole population at once. Individual j is crossed with
+    individual N-j-1 with probability PC, swapping half of the genes (roulette two point
+    crossover), and every individual has one random gene flipped with probability PM.
+    POPULATION_Y shares everything with POPULATION_X except the chromosomes that actually
+    change, which are new arrays; only those individuals get their fenotype decoded again.
+    The new chromosomes are canonicalized with GENE_MASK (see gene_mask) when given.
+    """
+    keys = list(POPULATION_X.keys())
+    POPULATION_Y = dict()
+    for key in keys:
+        POPULATION_Y[key] = dict(POPULATION_X[key])
+    GENLONG =  len(POPULATION_X[keys[0]]["CHROMOSOME"])
+    changed = dict()
+
+    #CROSSOVER
+    best_position  = np.arange(int(N/2))
+    worst_position = N - best_position - 1
+    crossover = np.random.uniform(0, 1, len(best_position)) < PC
+    genoma_crossover = np.random.randint(0, GENLONG + 1, len(best_position))
+    genoma_crossover_final = (genoma_crossover + np.round(GENLONG/2)).astype(int)
+    # To perform a roulette cross over the genes after GENLONG are taken from the start
+    extra_genes = np.maximum(genoma_crossover_final - GENLONG, 0)
+    genoma_crossover_final = np.minimum(genoma_crossover_final, GENLONG)
+
+    pairs = np.flatnonzero(crossover)
+    if len(pairs) > 0:
+        genes = np.arange(GENLONG)
+        swap = (genes < extra_genes[pairs, None]) | \
+               ((genes >= genoma_crossover[pairs, None]) & (genes < genoma_crossover_final[pairs, None]))
+        best  = np.vstack([POPULATION_X[keys[j]]["CHROMOSOME"] for j in best_position[pairs]])
+        worst = np.vstack([POPULATION_X[keys[j]]["CHROMOSOME"] for j in worst_position[pairs]])
+        new_best  = np.where(swap, worst, best)
+        new_worst = np.where(swap, best, worst)
+        for i, pair in enumerate(pairs):
+            changed[best_position[pair]]  = new_best[i]
+            changed[worst_position[pair]] = new_worst[i]
+
+    #MUTATION
+    mutated = np.flatnonzero(np.random.uniform(0, 1, len(keys)) < PM)
+    if GENLONG > 0:
+        mutation_gen = np.random.randint(0, GENLONG, len(mutated))
+        for j, gen in zip(mutated, mutation_gen):
+            if j not in changed:
+                changed[j] = POPULATION_X[keys[j]]["CHROMOSOME"].copy()
+            changed[j][gen] ^= 1
+
+    POPULATION_CHANGED = dict()
+    for j in changed.keys():
+        if GENE_MASK is not None:
+            changed[j] &= GENE_MASK
+        set_chromosome(POPULATION_Y[keys[j]], changed[j], len(columns_list))
+        POPULATION_CHANGED[keys[j]] = POPULATION_Y[keys[j]]
 
     #print("\n\n0 ******************** deben ser iguales\nTEST POPULATION diff POPULATION_Y")
     #test_baseline_xy(POPULATION_Y, POPULATION_X) #Prueba de que el genotipo ha sido efectivo
@@ -640,9 +1362,7 @@ def cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list, n_col, N, PC,
     #test_chromosome_xy(POPULATION_Y, POPULATION_X)
     #print("\n\n\n -------------------Here most mark Error")
     #test_fenotype_chromosome_POPULATION(POPULATION_Y, NEURONAL_SOLUTIONS, df_kfolded, n_col)
-    POPULATION_Y = change_fenotype_using_genoma(POPULATION_Y, NEURONAL_SOLUTIONS, n_col, columns_list)
-    print("\n\n**Second test in test_fenotype_chromosome_POPULATION")
-    test_fenotype_chromosome_POPULATION(POPULATION_Y, NEURONAL_SOLUTIONS, columns_list, n_col)
+    change_fenotype_using_genoma(POPULATION_CHANGED, NEURONAL_SOLUTIONS, n_col, columns_list)
     #print("\n\n2 ******************** deben cambiar \nTEST POPULATION diff POPULATION_Y")
     #test_baseline_xy(POPULATION_Y, POPULATION_X) #Prueba de que el genotipo ha sido efectivo
 
@@ -650,62 +1370,57 @@ def cross_mutate( POPULATION_X, NEURONAL_SOLUTIONS, columns_list, n_col, N, PC,
 
 
 
-
-
 def  change_fenotype_using_genoma(POPULATION, NEURONAL_SOLUTIONS, n_col, columns_list):
     """ After modifying the genoma of an individual it's necessary to change the fenotype
     acordingly to the genotype. In other words this fucntion change the "shape" or characteristics
     of the individual (columns used in the model fitting)  ti fit the model.
+    The chromosome parts are used as boolean masks over the feature names, so the fenotype
+    is correct by construction; INDIVIDUAL["FENOTYPE_GENOMA"] records the GENOMA it was
+    decoded from (see check_fenotype).
     """
+    baseline_all_features = np.array(columns_list, dtype = object)
+    exmodel_features = np.array(get_exmodel_features( NEURONAL_SOLUTIONS, n_col ), dtype = object)
     for individual in POPULATION.keys():
-        del POPULATION[individual]["exmodel_features"]
-        del POPULATION[individual]["baseline_features"]
-    for individual in POPULATION.keys():
-        cont = 0
-        baseline_all_features = columns_list.copy()
-        exmodel_features = get_exmodel_features( NEURONAL_SOLUTIONS, n_col )
+        baseline_mask = POPULATION[individual]["baseline_features_chromosome"].astype(bool)
+        exmodel_mask  = POPULATION[individual]["exmodel_features_chromosome"].astype(bool)
+        POPULATION[individual]["baseline_features"] = baseline_all_features[baseline_mask].tolist()
+        POPULATION[individual]["exmodel_features"]  = exmodel_features[exmodel_mask].tolist()
+        POPULATION[individual]["FENOTYPE_GENOMA"]   = POPULATION[individual]["GENOMA"]
 
-        baseline_features_selected = list()
-        exmodel_features_selected = list()
-        for chromosome in POPULATION[individual]["baseline_features_chromosome"]:
-            if int(chromosome) == 1:
-                feature_inbit = baseline_all_features[cont]
-                baseline_features_selected.append(feature_inbit)
-            cont += 1 
-        cont = 0
-        for chromosome in POPULATION[individual]["exmodel_features_chromosome"]:
-            if int(chromosome) == 1:
-                feature_inbit = exmodel_features[cont]
-                exmodel_features_selected.append(exmodel_features[cont])
-            cont += 1
+    return  POPULATION
 
-        POPULATION[individual]["exmodel_features"] = exmodel_features_selected
-        POPULATION[individual]["baseline_features"] = baseline_features_selected
-    print("\n\n\n -------------------Here most be ok")
-    test_fenotype_chromosome_POPULATION(POPULATION, NEURONAL_SOLUTIONS, columns_list, n_col)
 
-    return  POPULATION
 
 
+def check_fenotype(POPULATION):
+    """
+    O(1) per individual: raises ValueError when the fenotype of an individual was not
+    decoded from its current GENOMA (change_fenotype_using_genoma not called after
+    set_chromosome). The full scans are test_fenotype_chromosome_POPULATION/SOLUTIONS.
+    """
+    for individual in POPULATION.keys():
+        if POPULATION[individual].get("FENOTYPE_GENOMA") != POPULATION[individual]["GENOMA"]:
+            raise ValueError("The fenotype of individual {} was not decoded from its GENOMA".format(individual))
 
 
 def  test_fenotype_chromosome_POPULATION(POPULATION, NEURONAL_SOLUTIONS, columns_list, n_col):
     """ For each individual in POPULATION, compares that the fenotye(selected_features) correspond 
     to the sequence of the bits in the chromosome.
     """
-    print("Performing test_fenotype_chromosome on POPULATION")
     for individual in POPULATION.keys():
         baseline_features  = columns_list.copy()
         exmodel_features = get_exmodel_features( NEURONAL_SOLUTIONS, n_col )
+        baseline_selected = set(POPULATION[individual]["baseline_features"])
+        exmodel_selected  = set(POPULATION[individual]["exmodel_features"])
         cont = 0
         for chromosome in POPULATION[individual]["baseline_features_chromosome"]:
             feature_inbit  = baseline_features[cont]
             if int(chromosome) == 1:
                 #feature included
-                if feature_inbit not in  POPULATION[individual]["baseline_features"]:
+                if feature_inbit not in baseline_selected:
                     raise ValueError("ERROR: feature not in baseline_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             else: 
-                if feature_inbit in POPULATION[individual]["baseline_features"]:
+                if feature_inbit in baseline_selected:
                     raise ValueError("ERROR: feature in baseline_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             cont +=1 
         cont = 0
@@ -713,36 +1428,38 @@ def  test_fenotype_chromosome_POPULATION(POPULATION, NEURONAL_SOLUTIONS, columns
             feature_inbit  = exmodel_features[cont]
             if int(chromosome) == 1:
                 #feature included
-                if feature_inbit not in  POPULATION[individual]["exmodel_features"]:
+                if feature_inbit not in exmodel_selected:
                     raise ValueError("ERROR: feature not in exmodel_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             else: 
-                if feature_inbit in POPULATION[individual]["exmodel_features"]:
+                if feature_inbit in exmodel_selected:
                     raise ValueError("ERROR: feature in exmodel_features while {} chromosome is 0: {} ".format(cont, feature_inbit))
             cont +=1 
 
-        if POPULATION[individual]["GENOMA"] != POPULATION[individual]["baseline_features_chromosome"] + POPULATION[individual]["exmodel_features_chromosome"]:
+        chromosome = np.concatenate([POPULATION[individual]["baseline_features_chromosome"], POPULATION[individual]["exmodel_features_chromosome"]])
+        if POPULATION[individual]["GENOMA"] != genoma_key(chromosome):
             raise   ValueError("GENOMA differ from baseline_features_chromosome + exmodel_features_chromosome")  
 
-    print("\n\t**TEST PASSED: test_fenotype_chromosome_POPULATION")
+    logger.debug("TEST PASSED: test_fenotype_chromosome_POPULATION")
 
 
 def  test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_list, n_col):
     """ For each individual in POPULATION, compares that the fenotye(selected_features) correspond 
     to the sequence of the bits in the chromosome.
     """
-    print("Performing test_fenotype_chromosome on SOLUTIONS")
     for individual in SOLUTIONS.keys():
         baseline_features  = columns_list.copy()
         exmodel_features = get_exmodel_features( NEURONAL_SOLUTIONS, n_col )
+        baseline_selected = set(SOLUTIONS[individual]["baseline_features"])
+        exmodel_selected  = set(SOLUTIONS[individual]["exmodel_features"])
         cont = 0
         for chromosome in SOLUTIONS[individual]["baseline_features_chromosome"]:
             feature_inbit  = baseline_features[cont]
             if int(chromosome) == 1:
                 #feature included
-                if feature_inbit not in  SOLUTIONS[individual]["baseline_features"]:
+                if feature_inbit not in baseline_selected:
                     raise ValueError("ERROR: feature not in baseline_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             else: 
-                if feature_inbit in SOLUTIONS[individual]["baseline_features"]:
+                if feature_inbit in baseline_selected:
                     raise ValueError("ERROR: feature in baseline_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             cont +=1 
         cont = 0
@@ -750,13 +1467,35 @@ def  test_fenotype_chromosome_SOLUTIONS(SOLUTIONS, NEURONAL_SOLUTIONS, columns_l
             feature_inbit  = exmodel_features[cont]
             if int(chromosome) == 1:
                 #feature included
-                if feature_inbit not in  SOLUTIONS[individual]["exmodel_features"]:
+                if feature_inbit not in exmodel_selected:
                     raise ValueError("ERROR: feature not in exmodel_features while {} chromosome is 1: {}".format(cont,feature_inbit))
             else: 
-                if feature_inbit in SOLUTIONS[individual]["exmodel_features"]:
+                if feature_inbit in exmodel_selected:
                     raise ValueError("ERROR: feature in exmodel_features while {} chromosome is 0: {} ".format(cont, feature_inbit))
             cont +=1 
-    print("\n\t**TEST PASSED: test_fenotype_chromosome_SOLUTIONS")
+    logger.debug("TEST PASSED: test_fenotype_chromosome_SOLUTIONS")
+
+
+def test_fold_matrix_POPULATION(POPULATION, FOLDS, df_exmodel = None):
+    """ For each individual in POPULATION and each fold, compares the matrices of the column-block
+    cache (utils_fold_store.fold_matrix), built after the individuals before it, with the columns
+    of the individual taken directly from FOLDS["X"] in the same order. The score of an individual
+    must not depend on what the process scored before.
+    """
+    for individual in POPULATION.keys():
+        columns = feature_columns(FOLDS, POPULATION[individual], df_exmodel)
+        for test_fold in FOLDS["folds"]:
+            X_train, X_test, features = utils_fold_store.fold_matrix(FOLDS, test_fold, columns)
+            train_rows = FOLDS["plan"][test_fold]["train"]
+            test_rows  = FOLDS["plan"][test_fold]["test"]
+            if not (np.array_equal(X_train, FOLDS["X"][np.ix_(train_rows, columns)]) and
+                    np.array_equal(X_test, FOLDS["X"][np.ix_(test_rows, columns)])):
+                raise ValueError("ERROR: fold matrix of individual {} differs from its columns at fold {}".format(
+                                 individual, test_fold))
+            if features != [FOLDS["columns"][column] for column in columns]:
+                raise ValueError("ERROR: fold matrix features of individual {} out of order at fold {}".format(
+                                 individual, test_fold))
+    logger.debug("TEST PASSED: test_fold_matrix_POPULATION")
 
 
 def report_genetic_results(genoma, MODEL):